@@ -0,0 +1,332 @@
+# Copyright (c) 2017 David LePage
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = """
+---
+connection: smc_client
+short_description: Persistent connection to the Stonesoft Management Center
+description:
+  - Keeps a single authenticated smc-python session, its entry points and
+    the element resolution cache alive in a long lived local process for the
+    duration of the play. Stonesoft modules run with this connection send
+    their parameters to this process over a local socket and are executed
+    there, removing the smc-python import and the login/logout from each task.
+    Credentials are taken from the connection options, or from ~.smcrc or the
+    environment the same way smc-python does if not provided.
+  - A module run with this connection fails if its smc_address, smc_api_key or
+    smc_api_version differ from the connection session. If only smc_domain
+    differs, the session is switched to that domain for the module run.
+version_added: '2.5'
+options:
+  smc_address:
+    description:
+      - FQDN with port of SMC
+    vars:
+      - name: ansible_smc_address
+    env:
+      - name: SMC_ADDRESS
+  smc_api_key:
+    description:
+      - API key for api client
+    vars:
+      - name: ansible_smc_api_key
+    env:
+      - name: SMC_API_KEY
+  smc_api_version:
+    description:
+      - Optional API version to connect to. If none is provided, the latest
+        SMC version API will be used
+    vars:
+      - name: ansible_smc_api_version
+    env:
+      - name: SMC_API_VERSION
+  smc_timeout:
+    type: int
+    description:
+      - Timeout for connections to the SMC
+    default: 30
+    vars:
+      - name: ansible_smc_timeout
+    env:
+      - name: SMC_TIMEOUT
+  smc_domain:
+    description:
+      - Optional domain to log in to
+    vars:
+      - name: ansible_smc_domain
+    env:
+      - name: SMC_DOMAIN
+  smc_alt_filepath:
+    description:
+      - Alternate path to the smc-python credential file
+    vars:
+      - name: ansible_smc_alt_filepath
+  smc_verify:
+    type: boolean
+    description:
+      - Verify the SMC certificate for HTTPS connections
+    default: True
+    vars:
+      - name: ansible_smc_verify
+  smc_cache_ttl:
+    type: int
+    description:
+      - Time in seconds an element resolved by a module is kept in the shared
+        resolution cache of this connection
+    default: 600
+    vars:
+      - name: ansible_smc_cache_ttl
+  persistent_connect_timeout:
+    type: int
+    description:
+      - Configures, in seconds, the amount of time to wait when trying to
+        initially establish a persistent connection, and the idle time after
+        which the connection is closed
+    default: 30
+    ini:
+      - section: persistent_connection
+        key: connect_timeout
+    env:
+      - name: ANSIBLE_PERSISTENT_CONNECT_TIMEOUT
+    vars:
+      - name: ansible_connect_timeout
+  persistent_command_timeout:
+    type: int
+    description:
+      - Configures, in seconds, the amount of time to wait for a module run
+        in the connection process to complete
+    default: 300
+    ini:
+      - section: persistent_connection
+        key: command_timeout
+    env:
+      - name: ANSIBLE_PERSISTENT_COMMAND_TIMEOUT
+    vars:
+      - name: ansible_command_timeout
+  persistent_log_messages:
+    type: boolean
+    description:
+      - Log the requests and responses sent over the local socket in the
+        ansible log file. This will include module parameters
+    default: False
+    ini:
+      - section: persistent_connection
+        key: log_messages
+    env:
+      - name: ANSIBLE_PERSISTENT_LOG_MESSAGES
+    vars:
+      - name: ansible_persistent_log_messages
+"""
+
+import io
+import os
+import sys
+import json
+import time
+
+from ansible import constants as C
+from ansible.errors import AnsibleConnectionFailure
+from ansible.module_utils import basic
+from ansible.module_utils._text import to_bytes, to_native
+from ansible.plugins.connection import NetworkConnectionBase
+from ansible.plugins.loader import module_loader
+
+
+def load_source(name, path):
+    """
+    Load a python source file as a module and register it in sys.modules
+
+    :param str name: module name to register
+    :param str path: path to the source file
+    :return: module
+    """
+    try:
+        from importlib.util import spec_from_file_location, module_from_spec
+    except ImportError:
+        import imp
+        return imp.load_source(name, path)
+    spec = spec_from_file_location(name, path)
+    module = module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_stonesoft_util():
+    """
+    Load stonesoft_util from the configured module_utils path. Modules
+    import it as ansible.module_utils.stonesoft_util, which only exists
+    on the controller if install.py was used.
+
+    :return: stonesoft_util module
+    """
+    name = 'ansible.module_utils.stonesoft_util'
+    if name in sys.modules:
+        return sys.modules[name]
+    for path in C.DEFAULT_MODULE_UTILS_PATH or []:
+        source = os.path.join(os.path.expanduser(path), 'stonesoft_util.py')
+        if os.path.isfile(source):
+            return load_source(name, source)
+    import ansible.module_utils.stonesoft_util as stonesoft_util
+    return stonesoft_util
+
+
+class ElementStore(object):
+    """
+    In memory store for resolved elements shared by all modules run
+    through this connection. Implements the same interface as
+    stonesoft_util.PersistentCache so it can be set as Cache.store.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {} # typeof: {name: (timestamp, element)}
+
+    def get(self, typeof, name):
+        entry = self.entries.get(typeof, {}).get(name)
+        if entry and time.time() - entry[0] < self.ttl:
+            return entry[1]
+
+    def set(self, typeof, element):
+        self.entries.setdefault(typeof, {})[element.name] = (time.time(), element)
+
+    def invalidate(self, name, typeof=None):
+        for key, values in self.entries.items():
+            entry = values.get(name)
+            if entry and (typeof is None or typeof in (key, entry[1].typeof)):
+                values.pop(name)
+
+    def save(self):
+        pass
+
+
+class Connection(NetworkConnectionBase):
+    ''' Persistent connection to the Stonesoft Management Center '''
+
+    transport = 'smc_client'
+    has_pipelining = True
+
+    def __init__(self, play_context, new_stdin, *args, **kwargs):
+        super(Connection, self).__init__(play_context, new_stdin, *args, **kwargs)
+        self._util = None
+        self._store = None
+        self._logged_in = False
+        self._domain = None
+        self._modules = {} # module name: loaded module
+
+    def update_play_context(self, pc_data):
+        """
+        Play context changes do not affect the SMC session
+        """
+        pass
+
+    def _connect(self):
+        if self._logged_in:
+            return
+        self._util = load_stonesoft_util()
+        if not self._util.import_smc():
+            raise AnsibleConnectionFailure(
+                'Could not import smc-python required by this connection')
+
+        from smc import session
+        from smc.api.exceptions import ConfigLoadError, SMCException
+
+        try:
+            if self.get_option('smc_address') and self.get_option('smc_api_key'):
+                session.login(
+                    url=self.get_option('smc_address'),
+                    api_key=self.get_option('smc_api_key'),
+                    api_version=self.get_option('smc_api_version'),
+                    timeout=self.get_option('smc_timeout'),
+                    domain=self.get_option('smc_domain'),
+                    verify=self.get_option('smc_verify'))
+            elif self.get_option('smc_alt_filepath'):
+                session.login(alt_filepath=self.get_option('smc_alt_filepath'))
+            else:
+                # From user ~.smcrc or environment
+                session.login()
+        except (ConfigLoadError, SMCException) as err:
+            raise AnsibleConnectionFailure(
+                'Unable to log in to the SMC: %s' % to_native(err))
+
+        self.queue_message('vvv', 'ESTABLISH SMC SESSION TO %s IN DOMAIN %s' %
+            (session.url, session.domain))
+        self._domain = session.domain
+
+        self._util.StonesoftModuleBase.persistent = True
+        self._store = ElementStore(self.get_option('smc_cache_ttl'))
+        self._logged_in = self._connected = True
+
+    def run_module(self, name, params, check_mode=False):
+        """
+        Run a Stonesoft module in this process using the active session.
+        Module output is captured from exit_json or fail_json and returned
+        to the calling module.
+
+        :param str name: name of the module
+        :param dict params: module parameters
+        :param bool check_mode: whether the task runs in check mode
+        :return: module result
+        :rtype: dict
+        """
+        self._connect()
+        module = self._modules.get(name)
+        if module is None:
+            path = module_loader.find_plugin(name, mod_type='.py')
+            if path is None:
+                raise AnsibleConnectionFailure('Module %s could not be found' % name)
+            module = self._modules[name] = load_source(
+                'ansible_module_%s' % name, path)
+
+        args = {k: v for k, v in params.items() if v is not None}
+        args.update(
+            _ansible_check_mode=check_mode,
+            _ansible_module_name=name)
+
+        self._util.Cache.store = self._store
+        basic._ANSIBLE_ARGS = to_bytes(json.dumps({'ANSIBLE_MODULE_ARGS': args}))
+        stdout, sys.stdout = sys.stdout, io.BytesIO() if str is bytes else io.StringIO()
+        try:
+            module.main()
+        except SystemExit:
+            pass
+        finally:
+            output, sys.stdout = sys.stdout.getvalue(), stdout
+            basic._ANSIBLE_ARGS = None
+            self._util.Cache.store = None
+            self._restore_domain()
+
+        lines = output.strip().splitlines()
+        if not lines:
+            raise AnsibleConnectionFailure('Module %s returned no result' % name)
+        result = json.loads(lines[-1])
+        result.pop('invocation', None)
+        return result
+
+    def _restore_domain(self):
+        """
+        Switch the session back to the domain of the connection if a module
+        switched to its own smc_domain and did not switch back
+        """
+        from smc import session
+        from smc.api.exceptions import SMCException
+        if session.domain != self._domain:
+            try:
+                session.switch_domain(self._domain)
+            except SMCException as err:
+                self._logged_in = False
+                raise AnsibleConnectionFailure(
+                    'Unable to switch back to domain %s: %s' % (self._domain, to_native(err)))
+
+    def close(self):
+        """
+        Log out the SMC session when the connection is closed
+        """
+        if self._logged_in:
+            from smc import session
+            self.queue_message('vvvv', 'closing SMC session')
+            session.logout()
+            self._logged_in = False
+        super(Connection, self).close()
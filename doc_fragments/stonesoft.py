@@ -53,6 +53,39 @@ options:
           - Full path to the log file
         type: str
         required: true
+  smc_cache:
+    description:
+      - Optionally store resolved element references on disk so they can be re-used
+        by subsequent tasks against the same SMC and domain. Entries are removed when
+        an element is created or deleted by a module.
+    required: false
+    type: dict
+    suboptions:
+      path:
+        description:
+          - Directory where cache files are stored
+        type: str
+        required: true
+      ttl:
+        description:
+          - Time in seconds a cached element reference is considered valid
+        type: int
+        default: 600
+  smc_session:
+    description:
+      - Optionally keep the SMC session open after the module completes and store it on
+        disk so subsequent tasks against the same SMC, domain and API version re-use it
+        instead of logging in again. The stored session is validated before use and a new
+        login is done if it has expired. Credentials are not stored.
+    required: false
+    type: dict
+    suboptions:
+      path:
+        description:
+          - Directory where session files are stored. The session file contains the
+            session cookie and is created with owner only permissions.
+        type: str
+        required: true
   smc_extra_args:
     description: 
       - Extra arguments to pass to login constructor. These are generally only used if
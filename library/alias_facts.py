@@ -87,14 +87,6 @@ aliases:
 from ansible.module_utils.stonesoft_util import StonesoftModuleBase
 
 
-try:
-    from smc.elements.network import Alias
-    from smc.core.engine import Engine
-    from smc.api.exceptions import ElementNotFound
-except ImportError:
-    pass
-
-
 def alias_dict_from_obj(alias, engine):
     """
     Return dict of alias data. If engine is provided, resolve
@@ -134,6 +126,10 @@ class AliasFacts(StonesoftModuleBase):
         super(AliasFacts, self).__init__(self.module_args, is_fact=True)
 
     def exec_module(self, **kwargs):
+        from smc.elements.network import Alias
+        from smc.core.engine import Engine
+        from smc.api.exceptions import ElementNotFound
+        
         for name, value in kwargs.items():
             setattr(self, name, value)
         
@@ -80,12 +80,6 @@ categories:
 from ansible.module_utils.stonesoft_util import StonesoftModuleBase
 
 
-try:
-    from smc.elements.other import Category
-except ImportError:
-    pass
-
-
 def category_dict_from_obj(element):
     """
     Resolve the category to the supported types and return a dict
@@ -123,6 +117,8 @@ class CategoryFacts(StonesoftModuleBase):
         super(CategoryFacts, self).__init__({}, is_fact=True)
 
     def exec_module(self, **kwargs):
+        from smc.elements.other import Category
+        
         for name, value in kwargs.items():
             setattr(self, name, value)
         
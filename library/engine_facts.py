@@ -34,6 +34,23 @@ options:
       - ips_clusters
       - fw_clusters
     type: str
+  engines:
+    description:
+      - List of engine names to retrieve. Each name must match an engine exactly.
+        Mutually exclusive with I(filter)
+    type: list
+  match_all:
+    description:
+      - When I(as_yaml) is set, convert every engine matching I(filter). By default
+        only the engine with a name equal to the filter is converted.
+    type: bool
+    default: false
+  workers:
+    description:
+      - Number of engines converted concurrently when I(as_yaml) is set. Zone names
+        and policy VPN gateway nodes are shared by all engines.
+    type: int
+    default: 1
   
 extends_documentation_fragment:
   - stonesoft
@@ -80,6 +97,14 @@ EXAMPLES = '''
       filter: newcluster
       as_yaml: true
 
+  - name: Get engine details for all engines of a site in YAML format
+    engine_facts:
+      element: fw_clusters
+      filter: site1
+      match_all: true
+      as_yaml: true
+      workers: 8
+
   - name: Write the yaml using a jinja template
     template: src=templates/engine_yaml.j2 dest=./l3fw_cluster.yml
 '''
@@ -218,7 +243,9 @@ engines:
         "type": "single_fw" }]
     }]
 '''
-from ansible.module_utils.stonesoft_util import StonesoftModuleBase
+import threading
+from ansible.module_utils.stonesoft_util import (
+    StonesoftModuleBase, run_concurrent, size_session_pool)
 
 
 ENGINE_TYPES = frozenset(['fw_clusters', 'engine_clusters', 'ips_clusters',
@@ -226,6 +253,8 @@ ENGINE_TYPES = frozenset(['fw_clusters', 'engine_clusters', 'ips_clusters',
 
 
 try:
+    from smc.base.model import Element
+    from smc.base.collection import Search
     from smc.elements.network import Zone
     from smc.vpn.policy import PolicyVPN
     from smc.core.sub_interfaces import ClusterVirtualInterface
@@ -235,13 +264,34 @@ except ImportError:
     pass
 
 
-def zone_finder(zones, zone):
-    for z in zones:
-        if z.href == zone:
-            return z.name
-
-
-def yaml_cluster(engine):
+class ZoneMap(object):
+    """
+    Map of zone href to zone name shared by all engines converted in a
+    module run. All zones are listed once on first use, a zone that is
+    not in the listing is fetched by href.
+    """
+    def __init__(self):
+        self.zones = None # href: name
+        self.lock = threading.Lock()
+    
+    def get(self, href):
+        """
+        Name of the zone referenced by href
+        
+        :param str href: zone_ref of an interface
+        :rtype: str or None
+        """
+        if self.zones is None:
+            with self.lock:
+                if self.zones is None:
+                    self.zones = {zone.href: zone.name for zone in Zone.objects.all()}
+        if href not in self.zones:
+            zone = Element.from_href(href)
+            self.zones[href] = zone.name if zone else None
+        return self.zones[href]
+
+
+def yaml_cluster(engine, zones=None, vpns=None):
     """
     Example interface dict created from cluster engine:
         
@@ -262,8 +312,9 @@ def yaml_cluster(engine):
     `network_value` and `nodeid` if the interface definition
     has interface addresses assigned.
     """
-    # Prefetch all zones to reduce queries
-    zone_cache = list(Zone.objects.all())
+    # Zones are listed once and shared between engines
+    if zones is None:
+        zones = ZoneMap()
     management = ('primary_mgt', 'backup_mgt', 'primary_heartbeat')
     yaml_engine = {'name': engine.name, 'type': engine.type}
     interfaces = []
@@ -282,8 +333,7 @@ def yaml_cluster(engine):
         if getattr(interface, 'comment', None):
             top_itf.update(comment=interface.comment)
         if interface.zone_ref:
-            top_itf.update(zone_ref=zone_finder(
-                zone_cache, interface.zone_ref))
+            top_itf.update(zone_ref=zones.get(interface.zone_ref))
         
         cvi_mode = getattr(interface, 'cvi_mode', None)
         if cvi_mode is not None and cvi_mode != 'none':
@@ -361,8 +411,7 @@ def yaml_cluster(engine):
                                     yaml_engine[role] = getattr(sub_vlan, 'nicid')
             
                         if vlan.zone_ref:
-                            itf.update(zone_ref=zone_finder(
-                                zone_cache, vlan.zone_ref))
+                            itf.update(zone_ref=zones.get(vlan.zone_ref))
                         
                         nodes.setdefault('nodes', []).append(node)
                         
@@ -376,8 +425,7 @@ def yaml_cluster(engine):
                 else:
                     # Empty VLAN, check for zone
                     if vlan.zone_ref:
-                        itf.update(zone_ref=zone_finder(
-                            zone_cache, vlan.zone_ref))
+                        itf.update(zone_ref=zones.get(vlan.zone_ref))
                     
                     top_itf.setdefault('interfaces', []).append(itf)    
                     
@@ -477,7 +525,7 @@ def yaml_cluster(engine):
         yaml_engine.update(netlinks=netlinks)
     
     # Policy VPN
-    policy_vpn = get_policy_vpn(engine)
+    policy_vpn = get_policy_vpn(engine, vpns)
     if policy_vpn:
         yaml_engine.update(policy_vpn=policy_vpn)
      
@@ -488,7 +536,43 @@ def yaml_cluster(engine):
     return yaml_engine
 
 
-def get_policy_vpn(engine):
+class PolicyVPNIndex(object):
+    """
+    Read-only index of the gateway nodes of each policy VPN, shared by
+    all engines converted in a module run. Each policy VPN is read once
+    and is not opened for editing, so no lock is taken on the VPN.
+    """
+    def __init__(self):
+        self.vpns = {} # name: {central: [..], satellite: [..], mobile: [..]}
+        self.locks = {} # name: Lock
+        self.lock = threading.Lock()
+    
+    def get(self, name):
+        """
+        Names of the central, satellite and mobile gateway nodes of the
+        policy VPN. Mobile is None if the VPN has no mobile topology.
+        
+        :param str name: name of the policy VPN
+        :rtype: dict
+        """
+        # Each policy VPN has its own lock so engines using different
+        # VPNs are not serialized while the gateway nodes are fetched
+        with self.lock:
+            lock = self.locks.setdefault(name, threading.Lock())
+        with lock:
+            if name not in self.vpns:
+                vpn = PolicyVPN(name)
+                self.vpns[name] = dict(
+                    central=[node.name for node in vpn.central_gateway_node],
+                    satellite=[node.name for node in vpn.satellite_gateway_node],
+                    mobile=[node.name for node in vpn.mobile_gateway_node]
+                        if vpn.mobile_vpn_topology != 'None' else None)
+            return self.vpns[name]
+
+
+def get_policy_vpn(engine, vpns=None):
+    if vpns is None:
+        vpns = PolicyVPNIndex()
     vpn_mappings = engine.vpn_mappings
     engine_internal_gw = engine.vpn.internal_gateway.name
     policy_vpn = []
@@ -498,30 +582,28 @@ def get_policy_vpn(engine):
             mapped_vpn = mapping.vpn
             if mapped_vpn.name not in _seen:
                 _vpn = {'name': mapped_vpn.name}
-                vpn = PolicyVPN(mapped_vpn.name)
-                vpn.open()
-                nodes = vpn.central_gateway_node
-                node_central = nodes.get_contains(engine_internal_gw)
-                _vpn.update(central_node=True if node_central else False)
+                nodes = vpns.get(mapped_vpn.name)
+                # Partial match on the node name as done by get_contains
+                member = lambda role: any(
+                    engine_internal_gw in node for node in nodes[role])
+                node_central = member('central')
+                _vpn.update(central_node=node_central)
                 if not node_central: # If it's a central node it can't be a satellite node
-                    nodes = vpn.satellite_gateway_node
-                    _vpn.update(satellite_node=True if nodes.get_contains(engine_internal_gw) else False)
+                    _vpn.update(satellite_node=member('satellite'))
                 else:
                     _vpn.update(satellite_node=False)
-                if vpn.mobile_vpn_topology != 'None':
-                    mobile_node = vpn.mobile_gateway_node
-                    _vpn.update(mobile_gateway=True if mobile_node.get_contains(engine_internal_gw) else False)
+                if nodes['mobile'] is not None:
+                    _vpn.update(mobile_gateway=member('mobile'))
                 
                 policy_vpn.append(_vpn)
-                vpn.close()
                 _seen.append(mapped_vpn.name)
     return policy_vpn
 
     
-def to_yaml(engine):
+def to_yaml(engine, zones=None, vpns=None):
     if 'single_fw' in engine.type or 'cluster' in engine.type:
         #return yaml_firewall(engine)
-        return yaml_cluster(engine)
+        return yaml_cluster(engine, zones, vpns)
     else:
         raise ValueError('Only single FW and cluster FW types are '
             'currently supported.')
@@ -531,37 +613,71 @@ class EngineFacts(StonesoftModuleBase):
     def __init__(self):
         
         self.module_args = dict(
-            element=dict(default='engine_clusters', type='str', choices=list(ENGINE_TYPES))
+            element=dict(default='engine_clusters', type='str', choices=list(ENGINE_TYPES)),
+            engines=dict(type='list'),
+            match_all=dict(type='bool', default=False),
+            workers=dict(type='int', default=1)
         )
     
         self.element = None
+        self.engines = None
+        self.match_all = None
+        self.workers = None
         self.limit = None
         self.filter = None
         self.as_yaml = None
         self.exact_match = None
         self.case_sensitive = None
         
-        required_if=([
-            ('as_yaml', True, ['filter'])])
+        mutually_exclusive = [
+            ['filter', 'engines'],
+        ]
         
         self.results = dict(
             ansible_facts=dict(
                 engines=[]
             )
         )
-        super(EngineFacts, self).__init__(self.module_args, required_if=required_if,
-                                          is_fact=True)
+        super(EngineFacts, self).__init__(self.module_args,
+            mutually_exclusive=mutually_exclusive, is_fact=True)
 
     def exec_module(self, **kwargs):
         for name, value in kwargs.items():
             setattr(self, name, value)
         
-        result = self.search_by_context()
+        if self.as_yaml and not (self.filter or self.engines):
+            self.fail(msg='filter or engines is required when as_yaml is set')
+        
+        if self.engines:
+            result = []
+            for name in self.engines:
+                engine = Search.objects.context_filter(self.element)\
+                    .filter(name, exact_match=True).first()
+                if not engine:
+                    self.fail(msg='Engine specified could not be found: %s' % name)
+                result.append(engine)
+        else:
+            result = self.search_by_context()
+        
         engines = []
-        if self.filter:
+        if self.filter or self.engines:
             if self.as_yaml:
-                engines = [to_yaml(engine) for engine in result
-                           if engine.name == self.filter]
+                if not (self.engines or self.match_all):
+                    result = [engine for engine in result if engine.name == self.filter]
+                
+                # Engines are converted concurrently and share the zone names
+                # and policy VPN gateway nodes
+                zones, vpns = ZoneMap(), PolicyVPNIndex()
+                def convert(engine):
+                    try:
+                        return to_yaml(engine, zones, vpns)
+                    except ValueError as err:
+                        raise ValueError('%s: %s' % (engine.name, err))
+                size_session_pool(self.workers)
+                try:
+                    engines = run_concurrent(convert, result, self.workers)
+                except ValueError as err:
+                    self.fail(msg=str(err))
             else:
                 engines = [engine.data.data for engine in result]
         else:
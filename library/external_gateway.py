@@ -227,7 +227,7 @@ class ExternalVPNGW(StonesoftModuleBase):
                         'VPN site configuration: %s' % cache.missing)
                 
                 site_element = [value.href for _, values in cache.cache.items()
-                        for value in values]
+                        for value in values.values()]
                 external_gateway.update(
                     vpn_site=[dict(name=site_name, site_element=site_element)])
         
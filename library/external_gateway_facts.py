@@ -118,10 +118,6 @@ from ansible.module_utils.stonesoft_util import (
     format_element)
 
 
-try:
-    from smc.vpn.elements import ExternalGateway
-except ImportError:
-    pass
 
 
 def to_yaml(gw):
@@ -202,6 +198,8 @@ class ExternalGWFacts(StonesoftModuleBase):
                                               is_fact=True)
 
     def exec_module(self, **kwargs):
+        from smc.vpn.elements import ExternalGateway
+        
         for name, value in kwargs.items():
             setattr(self, name, value)
         
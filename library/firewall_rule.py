@@ -333,14 +333,39 @@ options:
           - Provide a rule tag ID for which to add the rule before. This is only relevant for
             rules that are being created.
         type: str
+  bulk:
+    description:
+      - Build all new rules before any rule is created, then create them grouped
+        by their I(add_before) or I(add_after) anchor. Rules in the same group keep
+        the order they are defined in. Without bulk, each rule is inserted as it is
+        processed, so rules added after the same anchor or at the top of the policy
+        end up in reverse order.
+        Results are still reported per rule.
+    type: bool
+    default: false
+  resolve_workers:
+    description:
+      - Number of element lookups run concurrently when resolving the elements
+        referenced by the rules before any change is made. Lookups for each element
+        type and each user domain, user and group are independent and share the
+        connections of the SMC session.
+    type: int
+    default: 1
   state:
     description:
-      - Create or delete a firewall cluster
+      - Create, modify or delete the rules provided. When set to reconciled, the
+        rules provided are the complete rule set of the policy. Rules are matched to
+        existing rules by I(tag), or by I(name) if no tag is given, and only the
+        differences are applied. Rules that are matched are modified or moved if
+        needed, others are created and existing rules not in the list are deleted.
+        Rule sections are kept. Rule order follows the order of the list, so
+        I(add_before) and I(add_after) are ignored.
     required: false
     default: present
     choices:
       - present
       - absent
+      - reconciled
     
 '''
 
@@ -480,13 +505,29 @@ EXAMPLES = '''
     rules:
     -   tag: '2097203.0'
     state: absent
+
+- name: Reconcile the policy with the rules kept in the playbook
+  firewall_rule:
+    policy: TestPolicy
+    rules:
+    -   tag: '2097203.0'
+        name: allow dns
+        sources: any
+        destinations: any
+        services:
+          udp_service:
+          - DNS
+    -   name: my deny
+        action: discard
+    state: reconciled
 '''
+import bisect
 import traceback
 from ansible.module_utils.six import integer_types
 from ansible.module_utils.six import string_types
 
 from ansible.module_utils.stonesoft_util import (
-    StonesoftModuleBase, Cache)
+    StonesoftModuleBase, Cache, size_session_pool)
 
 
 try:
@@ -718,7 +759,148 @@ def get_tag(tag):
             return tag
         except ValueError:
             pass
-        
+
+
+def stable_rules(current, desired):
+    """
+    Longest common subsequence of the current and desired rule order.
+    Each rule appears once in both lists, so this is the longest
+    increasing subsequence of the current positions taken in desired
+    order. Rules in the result keep their relative order and do not
+    need to be moved.
+    
+    :param list current: rule tags in policy order
+    :param list desired: rule tags in desired order
+    :return: rule tags that stay in place
+    :rtype: set
+    """
+    position = {key: pos for pos, key in enumerate(current)}
+    keys = [key for key in desired if key in position]
+    tails, tail_index = [], [] # smallest end position per length
+    parent = [None] * len(keys)
+    for index, key in enumerate(keys):
+        length = bisect.bisect_left(tails, position[key])
+        if length:
+            parent[index] = tail_index[length - 1]
+        if length == len(tails):
+            tails.append(position[key])
+            tail_index.append(index)
+        else:
+            tails[length] = position[key]
+            tail_index[length] = index
+    
+    stable = set()
+    index = tail_index[-1] if tail_index else None
+    while index is not None:
+        stable.add(keys[index])
+        index = parent[index]
+    return stable
+
+
+class RuleIndex(object):
+    """
+    Index of the IPv4 access rules of a policy keyed by rule tag, with
+    the position of each rule in the policy. The rule list is fetched
+    once and only holds the rule meta data, so no request is made per
+    rule. The rule href ends with the tag without the revision, which
+    is used as the key. Tags not found in the index fall back to a
+    search on the policy.
+
+    :param FirewallPolicy policy: policy reference
+    """
+    def __init__(self, policy):
+        self.policy = policy
+        self.rules = None # tag: rule
+        self.positions = None # tag: position
+        self.names = None # name: tag
+
+    def refresh(self):
+        """
+        Fetch the rule list of the policy and rebuild the index
+        """
+        self.rules, self.positions, self.names = {}, {}, {}
+        for position, rule in enumerate(self.policy.fw_ipv4_access_rules, 1):
+            key = rule.href.rstrip('/').split('/')[-1]
+            self.rules[key] = rule
+            self.positions[key] = position
+            if rule.name:
+                self.names.setdefault(rule.name, key)
+    
+    def ordered(self):
+        """
+        Tags of all rules in the order of the policy
+
+        :rtype: list(str)
+        """
+        if self.positions is None:
+            self.refresh()
+        return sorted(self.positions, key=self.positions.get)
+
+    def get(self, tag):
+        """
+        Get the rule referenced by it's tag. Tag will be in format
+        '1234566.0', the revision is ignored.
+
+        :param str tag: tag
+        :rtype: Rule or None
+        """
+        if self.rules is None:
+            self.refresh()
+        key = get_tag(tag) or tag
+        rule = self.rules.get(key)
+        if rule is None:
+            result = self.policy.search_rule('@{}'.format(key))
+            if result:
+                rule = self.rules[key] = result[0]
+        return rule
+
+    def position(self, tag):
+        """
+        Position of the rule in the policy, starting at 1
+
+        :param str tag: tag
+        :rtype: int or None
+        """
+        if self.positions is None:
+            self.refresh()
+        return self.positions.get(get_tag(tag) or tag)
+
+    def deleted(self, rule):
+        """
+        Remove a deleted rule from the index. Rules after it move up
+        by one position.
+
+        :param Rule rule: rule that was deleted
+        """
+        key = self._key(rule)
+        if key is None:
+            return
+        self.rules.pop(key, None)
+        position = self.positions.pop(key, None) if self.positions else None
+        if position is not None:
+            for tag, pos in self.positions.items():
+                if pos > position:
+                    self.positions[tag] = pos - 1
+
+    def moved(self, rule):
+        """
+        Remove a moved rule from the index. A move creates a copy of
+        the rule with new references, positions are rebuilt when next
+        requested.
+
+        :param Rule rule: rule before the move
+        """
+        key = self._key(rule)
+        if key is not None:
+            self.rules.pop(key, None)
+        self.positions = None
+
+    def _key(self, rule):
+        if self.rules:
+            for key, value in self.rules.items():
+                if value.href == rule.href:
+                    return key
+
 
 class FirewallRule(StonesoftModuleBase):
     def __init__(self):
@@ -728,7 +910,10 @@ class FirewallRule(StonesoftModuleBase):
             sub_policy=dict(type='str'),
             rules=dict(type='list', default=[]),
             inspection_policy=dict(type='str'),
-            state=dict(default='present', type='str', choices=['present', 'absent'])
+            bulk=dict(type='bool', default=False),
+            resolve_workers=dict(type='int', default=1),
+            state=dict(default='present', type='str',
+                choices=['present', 'absent', 'reconciled'])
         )
         
         self.policy = None
@@ -736,6 +921,9 @@ class FirewallRule(StonesoftModuleBase):
         self.template = None
         self.rules = None
         self.inspection_policy = None
+        self.bulk = None
+        self.resolve_workers = None
+        self.rule_index = None
         
         mutually_exclusive = [
             ['policy', 'sub_policy'],
@@ -768,7 +956,11 @@ class FirewallRule(StonesoftModuleBase):
             else:
                 policy = FirewallSubPolicy.get(self.sub_policy)
             
-            if state == 'present':
+            # Rules referenced by tag are looked up in an index of the
+            # policy, fetched once on first use
+            self.rule_index = RuleIndex(policy)
+            
+            if state in ('present', 'reconciled'):
                 
                 for rule in self.rules:
                     try:
@@ -776,104 +968,65 @@ class FirewallRule(StonesoftModuleBase):
                     except Exception as e:
                         self.fail(msg=str(e))
         
-                self.cache = Cache()
-
+                self.cache = Cache(workers=max(self.resolve_workers, 1))
+                size_session_pool(self.resolve_workers)
+                
+                # Elements referenced by all rules are collected first so
+                # they can be resolved by typeof in a single pass
+                pending = []
                 for rule in self.rules:
-                    # Resolve elements if they exist, calls to SMC could happen here
                     if 'sources' in rule:
-                        self.field_resolver(rule.get('sources'), rule_targets)
+                        pending.extend(
+                            self.field_resolver(rule.get('sources'), rule_targets))
                     
                     if 'destinations' in rule:
-                        self.field_resolver(rule.get('destinations'), rule_targets)
+                        pending.extend(
+                            self.field_resolver(rule.get('destinations'), rule_targets))
                     
                     if 'services' in rule:
-                        self.field_resolver(rule.get('services'), service_targets)
+                        pending.extend(
+                            self.field_resolver(rule.get('services'), service_targets))
                     
                     if 'vpn_policy' in rule:
-                        self.cache._add_entry('vpn', rule.get('vpn_policy'))
+                        pending.append({'vpn': [rule.get('vpn_policy')]})
                         
                     if 'sub_policy' in rule:
-                        self.cache._add_entry('sub_ipv4_fw_policy', rule.get('sub_policy'))
+                        pending.append({'sub_ipv4_fw_policy': [rule.get('sub_policy')]})
                     
                     if 'authentication_options' in rule:
                         auth = rule['authentication_options']
                         if auth.get('require_auth'):
-                            for method in auth.get('methods'):
-                                self.cache._add_entry('authentication_service', method)
-                            
-                            for accounts in ('users', 'groups'):
-                                self.cache._add_user_entries(accounts, auth.get(accounts, []))
+                            pending.append(
+                                {'authentication_service': auth.get('methods')})
+                
+                # Resolve elements if they exist, calls to SMC happen here
+                self.cache.add_many(pending)
+                
+                for accounts in ('users', 'groups'):
+                    entries = []
+                    for rule in self.rules:
+                        auth = rule.get('authentication_options', {})
+                        if auth.get('require_auth'):
+                            entries.extend(
+                                entry for entry in auth.get(accounts, [])
+                                if entry not in entries)
+                    if entries:
+                        self.cache._add_user_entries(accounts, entries)
 
                 if self.cache.missing:
                     self.fail(msg='Missing required elements that are referenced in this '
                         'configuration: %s' % self.cache.missing)
                 
+                if state == 'reconciled':
+                    self.results['changed'] = self.reconcile(policy)
+                    return self.results
+                
                 if self.check_mode:
                     return self.results
                 
+                pending = [] # New rules when created in bulk
                 for rule in self.rules:
-                    rule_dict = {}
-                
-                    if 'log_options' in rule:
-                        log_options = LogOptions()
-                        _log = rule['log_options']
-                        for name, value in log_options.items():
-                            if name not in _log:
-                                log_options.pop(name)
-            
-                        log_options.update(rule.get('log_options', {}))
-                        rule_dict.update(log_options=log_options)
-
-                    if 'connection_tracking' in rule:
-                        connection_tracking = ConnectionTracking()
-                        _ct = rule['connection_tracking']
-                        for name, value in connection_tracking.items():
-                            if name not in _ct:
-                                connection_tracking.pop(name)
-            
-                        connection_tracking.update(rule.get('connection_tracking',{}))
-                        rule_dict.update(connection_tracking=connection_tracking)
-                    
-                    action = Action()
-                    action.action = rule.get('action', 'allow')
-                    
-                    if 'inspection_options' in rule:
-                        _inspection = rule['inspection_options']
-                        for option in inspection_options:
-                            if option in _inspection:
-                                action[option] = _inspection.get(option)
-                    
-                    if 'authentication_options' in rule:
-                        _auth_options = rule['authentication_options']
-                        auth_options = AuthenticationOptions()
-                        
-                        if _auth_options.get('require_auth'):
-                            auth_options.update(methods=[
-                                self.get_value('authentication_service', m).href
-                                for m in _auth_options.get('methods', [])],
-                            require_auth=True)
-                            
-                            auth_options.update(users=[entry.href
-                                for entry in self.cache.get_type('user_element')])
-
-                        rule_dict.update(authentication_options=auth_options)
-                    
-                    rule_dict.update(action=action)
-                    
-                    for field in ('sources', 'destinations', 'services'):
-                        rule_dict[field] = self.get_values(rule.get(field, None))
-
-                    rule_dict.update(
-                        vpn_policy=self.get_value('vpn', rule.get('vpn_policy')),
-                        sub_policy=self.get_value('sub_ipv4_fw_policy', rule.get('sub_policy')),
-                        mobile_vpn=rule.get('mobile_vpn', False))
-                    
-                    if 'comment' in rule:
-                        rule_dict.update(comment=rule.get('comment'))
-                    
-                    rule_dict.update(
-                        name=rule.get('name'),
-                        is_disabled=rule.get('is_disabled', False))
+                    rule_dict = self.build_rule(rule)
                     
                     if 'tag' not in rule:
                         # If no tag is present, this is a create
@@ -881,6 +1034,10 @@ class FirewallRule(StonesoftModuleBase):
                             before=rule.get('add_before'),
                             after=rule.get('add_after'))
                         
+                        if self.bulk:
+                            pending.append(rule_dict)
+                            continue
+                        
                         rule = policy.fw_ipv4_access_rules.create(**rule_dict)
                         changed = True
                         self.results['state'].append({
@@ -891,21 +1048,23 @@ class FirewallRule(StonesoftModuleBase):
                     else:
                         # Modify as rule has 'tag' defined. Fetch the rule first
                         # by it's tag reference, skip if tag not found
-                        target_rule = self.rule_by_tag(policy, rule.get('tag'))
+                        target_rule = self.rule_index.get(rule.get('tag'))
                         if not target_rule:
                             continue
 
                         changes = compare_rules(target_rule, rule_dict)
                         # Changes have already been merged if any
                         if rule.get('add_after', None):
-                            rule_at_pos = self.rule_by_tag(policy, rule.get('add_after'))
+                            rule_at_pos = self.rule_index.get(rule.get('add_after'))
                             if rule_at_pos:
                                 target_rule.move_rule_after(rule_at_pos)
+                                self.rule_index.moved(target_rule)
                                 changes.append('add_after')
                         elif rule.get('add_before', None):
-                            rule_at_pos = self.rule_by_tag(policy, rule.get('add_before'))
+                            rule_at_pos = self.rule_index.get(rule.get('add_before'))
                             if rule_at_pos:
                                 target_rule.move_rule_before(rule_at_pos)
+                                self.rule_index.moved(target_rule)
                                 changes.append('add_before')
                         elif changes:
                             target_rule.save()
@@ -917,13 +1076,21 @@ class FirewallRule(StonesoftModuleBase):
                                 'type': target_rule.typeof,
                                 'action': 'modified',
                                 'changes': changes})
+                
+                for rule in self.bulk_create(policy, pending):
+                    changed = True
+                    self.results['state'].append({
+                        'rule': rule.name,
+                        'type': rule.typeof,
+                        'action': 'created'})
     
             elif state == 'absent':
                 for rule in self.rules:
                     if 'tag' in rule:
-                        target_rule = self.rule_by_tag(policy, rule.get('tag'))
+                        target_rule = self.rule_index.get(rule.get('tag'))
                         if target_rule:
                             target_rule.delete()
+                            self.rule_index.deleted(target_rule)
                             changed = True
                             self.results['state'].append({
                                 'rule': target_rule.name,
@@ -936,26 +1103,231 @@ class FirewallRule(StonesoftModuleBase):
         self.results['changed'] = changed
         return self.results
     
-    def rule_by_tag(self, policy, tag):
+    def build_rule(self, rule):
         """
-        Get the rule referenced by it's tag. Tag will be in format
-        '1234566.0'. When doing a search_rule, you must omit the part
-        after the dot(.) to find the rule.
+        Build the rule dict for a rule defined in yaml. The rule dict
+        matches the rule create constructor arguments and is also used
+        when comparing to an existing rule. Referenced elements must
+        already be in the cache.
+        
+        :param dict rule: firewall rule defined in yaml
+        :rtype: dict
+        """
+        rule_dict = {}
+
+        if 'log_options' in rule:
+            log_options = LogOptions()
+            _log = rule['log_options']
+            for name, value in log_options.items():
+                if name not in _log:
+                    log_options.pop(name)
+
+            log_options.update(rule.get('log_options', {}))
+            rule_dict.update(log_options=log_options)
+
+        if 'connection_tracking' in rule:
+            connection_tracking = ConnectionTracking()
+            _ct = rule['connection_tracking']
+            for name, value in connection_tracking.items():
+                if name not in _ct:
+                    connection_tracking.pop(name)
+
+            connection_tracking.update(rule.get('connection_tracking',{}))
+            rule_dict.update(connection_tracking=connection_tracking)
+
+        action = Action()
+        action.action = rule.get('action', 'allow')
+
+        if 'inspection_options' in rule:
+            _inspection = rule['inspection_options']
+            for option in inspection_options:
+                if option in _inspection:
+                    action[option] = _inspection.get(option)
+
+        if 'authentication_options' in rule:
+            _auth_options = rule['authentication_options']
+            auth_options = AuthenticationOptions()
+
+            if _auth_options.get('require_auth'):
+                auth_options.update(methods=[
+                    self.get_value('authentication_service', m).href
+                    for m in _auth_options.get('methods', [])],
+                require_auth=True)
+
+                auth_options.update(users=[entry.href
+                    for entry in self.cache.get_type('user_element')])
+
+            rule_dict.update(authentication_options=auth_options)
+
+        rule_dict.update(action=action)
+
+        for field in ('sources', 'destinations', 'services'):
+            rule_dict[field] = self.get_values(rule.get(field, None))
+
+        rule_dict.update(
+            vpn_policy=self.get_value('vpn', rule.get('vpn_policy')),
+            sub_policy=self.get_value('sub_ipv4_fw_policy', rule.get('sub_policy')),
+            mobile_vpn=rule.get('mobile_vpn', False))
+
+        if 'comment' in rule:
+            rule_dict.update(comment=rule.get('comment'))
+
+        rule_dict.update(
+            name=rule.get('name'),
+            is_disabled=rule.get('is_disabled', False))
+        
+        return rule_dict
+    
+    def bulk_create(self, policy, rule_dicts):
+        """
+        Create rules that were built before any rule was submitted. Rules
+        are grouped by their add_before/add_after anchor. Each rule added
+        after an anchor, or at the top of the policy when no anchor is
+        given, is inserted directly next to it, so those groups are
+        submitted in reverse to keep the order defined in the playbook.
         
         :param FirewallPolicy policy: policy reference
-        :param str tag: tag
-        :rtype: Rule or None
+        :param list rule_dicts: rule dicts as returned by build_rule
+        :return: created rules in the order provided
+        :rtype: list
+        """
+        groups = {} # (before, after): [index, ..]
+        for index, rule_dict in enumerate(rule_dicts):
+            groups.setdefault(
+                (rule_dict.get('before'), rule_dict.get('after')), []).append(index)
+        
+        created = {} # index: rule
+        try:
+            for (before, _), indexes in groups.items():
+                for index in (indexes if before else reversed(indexes)):
+                    created[index] = policy.fw_ipv4_access_rules.create(
+                        **rule_dicts[index])
+        except SMCException as err:
+            self.fail(msg='Bulk rule creation failed after creating %s of %s rules: %s' %
+                (len(created), len(rule_dicts), str(err)),
+                state=[{'rule': rule.name, 'type': rule.typeof, 'action': 'created'}
+                    for _, rule in sorted(created.items())],
+                exception=traceback.format_exc())
+        
+        return [rule for _, rule in sorted(created.items())]
+    
+    def reconcile(self, policy):
+        """
+        Reconcile the policy with the rules provided, which are the full
+        rule set. Rules are matched to existing rules by tag, or by name
+        when no tag is given. Matched rules that are not part of the
+        longest common subsequence of current and desired order are
+        moved, unmatched rules are created and existing rules that are
+        not provided are deleted. Moved and created rules are placed
+        before the next rule that stays in place, or after the last one.
+        In check mode the changes are reported but not applied.
+        
+        :param FirewallPolicy policy: policy reference
+        :return: whether changes were made
+        :rtype: bool
         """
-        resolved_tag = get_tag(tag)
-        rule = policy.search_rule('@{}'.format(resolved_tag))
-        if rule:
-            return rule[0]
+        index = self.rule_index
+        current = index.ordered()
+        
+        desired = [] # (tag or None, rule)
+        claimed = set()
+        for rule in self.rules:
+            if 'tag' in rule:
+                key = get_tag(rule['tag']) or rule['tag']
+            else:
+                key = index.names.get(rule.get('name'))
+            if key not in index.rules or key in claimed:
+                key = None
+            else:
+                claimed.add(key)
+            desired.append((key, rule))
         
+        stable = stable_rules(current, [key for key, _ in desired if key])
+        
+        changed = False
+        for key in current:
+            if key in claimed:
+                continue
+            target_rule = index.rules[key]
+            if target_rule.is_rule_section:
+                continue
+            if not self.check_mode:
+                target_rule.delete()
+            changed = True
+            self.results['state'].append({
+                'rule': target_rule.name,
+                'type': target_rule.typeof,
+                'action': 'deleted'})
+        
+        # Rules are placed before the next stable rule. Trailing rules are
+        # placed after the last stable rule, or at the top of the policy if
+        # no rule stays in place, in reverse to keep their order.
+        placements, pending = [], [] # (tag or None, rule, before, after)
+        last = None
+        for key, rule in desired:
+            if key in stable:
+                for pending_key, pending_rule in pending:
+                    placements.append((pending_key, pending_rule, key, None))
+                pending = []
+                last = key
+            else:
+                pending.append((key, rule))
+        for key, rule in reversed(pending):
+            placements.append((key, rule, None, last))
+        
+        for key, rule, before, after in placements:
+            rule_dict = self.build_rule(rule)
+            if key is None:
+                name = rule_dict.get('name')
+                if not self.check_mode:
+                    rule_dict.update(
+                        before=index.rules[before].tag if before else None,
+                        after=index.rules[after].tag if after else None)
+                    name = policy.fw_ipv4_access_rules.create(**rule_dict).name
+                changed = True
+                self.results['state'].append({
+                    'rule': name,
+                    'type': 'fw_ipv4_access_rule',
+                    'action': 'created'})
+            else:
+                # Changes are merged in the rule copied by the move
+                target_rule = index.rules[key]
+                changes = compare_rules(target_rule, rule_dict)
+                if not self.check_mode:
+                    if before:
+                        target_rule.move_rule_before(index.rules[before])
+                    else:
+                        target_rule.move_rule_after(index.rules[after])
+                changed = True
+                self.results['state'].append({
+                    'rule': target_rule.name,
+                    'type': target_rule.typeof,
+                    'action': 'modified',
+                    'changes': changes + ['position']})
+        
+        for key, rule in desired:
+            if key not in stable:
+                continue
+            target_rule = index.rules[key]
+            changes = compare_rules(target_rule, self.build_rule(rule))
+            if changes:
+                if not self.check_mode:
+                    target_rule.save()
+                changed = True
+                self.results['state'].append({
+                    'rule': target_rule.name,
+                    'type': target_rule.typeof,
+                    'action': 'modified',
+                    'changes': changes})
+        
+        return changed
+    
     def field_resolver(self, elements, types):
         """
         Field resolver, specific to retrieving network or service level
         elements in different formats. If elements are referencing existing
-        elements, they will be loaded in the cache for retrieval.
+        elements, they are returned so they can be loaded in the cache for
+        retrieval.
         
         Format #1, as list (elements are expected to exist):
             - tcp_service:
@@ -981,10 +1353,12 @@ class FirewallRule(StonesoftModuleBase):
         :param list elements: list of elements as parsed from YAML file
         :param dict type_dict: type dictionary for elements that should be
             supported for this run.
+        :return: list of element dicts to add to the cache
+        :rtype: list
         """
         if isinstance(elements, dict):
             if 'any' in elements or 'none' in elements:
-                return
+                return []
             
             for name, value in elements.items():
                 if name not in types:
@@ -994,13 +1368,14 @@ class FirewallRule(StonesoftModuleBase):
                     self.fail(msg='Elements specified for type: %s should be in list '
                         'format, got: %s' % (name, type(value)))
             
-            self.cache.add_many([elements])
+            return [elements]
 
         elif isinstance(elements, list):
             for entry in elements:
                 if not entry.startswith('http'):
                     self.fail(msg='List entry is expected to be the raw href of '
                         'the element. Received: %s' % entry)
+        return []
     
     def get_value(self, typeof, element):
         """
@@ -28,8 +28,25 @@ version_added: '2.5'
 options:
   filter:
     description:
-      - The name of the FW Policy for which to retrieve rules
-    required: true
+      - The name of the FW Policy for which to retrieve rules. Required unless
+        I(policies) is provided
+    type: str
+  policies:
+    description:
+      - List of FW Policy names for which to retrieve rules. Each name must match a
+        policy exactly. Policies are retrieved in a single run, see I(workers).
+        Mutually exclusive with I(filter)
+    type: list
+  match_all:
+    description:
+      - Retrieve rules for every policy matching I(filter) instead of failing when more
+        than one policy matches. If the filter contains the wildcard characters C(*),
+        C(?) or C([), it is matched as a shell style pattern against the full policy
+        name. When more than one policy is retrieved, I(output_file) and
+        I(previous_export) must contain C({policy}), which is replaced by the name
+        of each policy.
+    type: bool
+    default: false
   search:
     description:
       - Provide a search string for which to use as a match against a rule/s
@@ -38,7 +55,8 @@ options:
   rule_range:
     description:
       - Provide a rule range to retrieve. Firewall rules will be displayed based
-        on the ranges provided in a top down fashion.
+        on the ranges provided in a top down fashion. Only rules within the range
+        are fetched.
     type: str
   expand:
     description:
@@ -58,6 +76,44 @@ options:
         also use the provided jinja templates to format into yaml and reuse for playbook
         runs.
     type: bool
+  workers:
+    description:
+      - Number of requests run concurrently when I(as_yaml) is set. Rules are
+        processed in batches, the data of each rule in a batch is fetched
+        concurrently, then each element referenced by the batch that was not
+        already fetched. Rules are returned in policy order. When retrieving
+        multiple policies, policies are processed concurrently and the workers
+        are shared between them. Elements fetched for one policy are re-used
+        for the others.
+    type: int
+    default: 1
+  previous_export:
+    description:
+      - Path to a previous export of this policy written with I(output_file) and
+        I(as_yaml). Rules are compared by tag, which ends with the rule revision, and
+        only rules that were added, changed or removed since the previous export are
+        returned. Only changed and added rules are converted and have their referenced
+        elements fetched, so the same I(expand) settings as the previous export should
+        be used. If I(output_file) is also set, it is written as a full export using the
+        previous export for unchanged rules. Mutually exclusive with I(search) and
+        I(rule_range).
+    type: str
+  output_file:
+    description:
+      - Write the rules to this file as they are fetched instead of returning them
+        in the facts. Use this for large policies so rules do not have to be held in
+        memory. The facts will contain the file name and number of rules written.
+        The file is only replaced once all rules are written.
+    type: str
+  output_format:
+    description:
+      - Format of I(output_file). With json, each rule is written as a JSON document
+        on a single line. With yaml, each rule is written as an item of a YAML list.
+    choices:
+      - json
+      - yaml
+    default: json
+    type: str
   
 extends_documentation_fragment:
   - stonesoft
@@ -120,6 +176,31 @@ EXAMPLES = '''
       - destinations
       - sources
   
+  - name: Stream all rules of a large policy to a file
+    firewall_rule_facts:
+      filter: TestPolicy
+      as_yaml: true
+      output_file: ./TestPolicy_rules.json
+
+  - name: Return only the rules changed since the previous export and update it
+    firewall_rule_facts:
+      filter: TestPolicy
+      as_yaml: true
+      previous_export: ./TestPolicy_rules.json
+      output_file: ./TestPolicy_rules.json
+
+  - name: Back up all policies starting with 'Branch' in one run
+    firewall_rule_facts:
+      filter: Branch*
+      match_all: true
+      as_yaml: true
+      workers: 16
+      expand:
+      - sources
+      - destinations
+      - services
+      output_file: ./backup/{policy}.json
+
   - name: Write the yaml using a jinja template
     template: src=templates/facts_yaml.j2 dest=./firewall_rules_test.yml
     vars:
@@ -162,11 +243,19 @@ firewall_rule:
         "template": "Firewall Inspection Template"
     }]
 '''
+import os
+import json
+import fnmatch
+import tempfile
 import traceback
-from ansible.module_utils.stonesoft_util import StonesoftModuleBase
+from itertools import islice
+from collections import OrderedDict
+from ansible.module_utils.stonesoft_util import (
+    StonesoftModuleBase, run_concurrent, size_session_pool)
 
 try:
     from smc.api.exceptions import SMCException
+    from smc.base.model import Element
     from smc.policy.layer3 import FirewallPolicy
 except ImportError:
     pass
@@ -176,7 +265,111 @@ engine_type = ('single_fw', 'single_layer2', 'single_ips', 'virtual_fw',
     'fw_cluster', 'master_engine')
 
 
-def to_yaml(rule, expand=None):
+class ElementNames(object):
+    """
+    Memo of element href to (name, typeof), shared by all rules in a
+    facts run so each element referenced by the rules is fetched at
+    most once. Only the name and type are kept, not the element.
+    """
+    def __init__(self):
+        self.names = {} # href: (name, typeof) or None if not found
+    
+    def get(self, href):
+        """
+        Name and type of the element referenced by href
+        
+        :param str href: href of element
+        :return: (name, typeof) or None if the element could not be fetched
+        :rtype: tuple
+        """
+        if href not in self.names:
+            element = Element.from_href(href)
+            self.names[href] = (element.name, element.typeof) if element else None
+        return self.names[href]
+    
+    def name(self, href):
+        """
+        Name of the element referenced by href
+        
+        :param str href: href of element
+        :rtype: str or None
+        """
+        entry = self.get(href)
+        if entry:
+            return entry[0]
+    
+    def prefetch(self, hrefs, workers=1):
+        """
+        Fetch the elements not already known, running up to workers
+        requests concurrently
+        
+        :param hrefs: iterable of element hrefs
+        :param int workers: number of concurrent requests
+        """
+        hrefs = [href for href in set(hrefs) if href not in self.names]
+        for href, element in zip(hrefs,
+            run_concurrent(Element.from_href, hrefs, workers)):
+            self.names[href] = (element.name, element.typeof) if element else None
+
+
+def rule_hrefs(rule, expand=None):
+    """
+    Hrefs of the elements of a rule that are resolved by name in to_yaml
+    
+    :param Rule rule: rule with data loaded
+    :param list expand: cells that are expanded
+    :rtype: list
+    """
+    if rule.is_rule_section:
+        return []
+    hrefs = []
+    for field in expand or []:
+        hrefs.extend(getattr(rule, field).all_as_href())
+    hrefs.extend(rule.authentication_options.get('methods') or [])
+    for field in ('vpn', 'sub_policy'):
+        if rule.action.get(field):
+            hrefs.append(rule.action.get(field))
+    return hrefs
+
+
+def fetch_rules(rules, names, expand=None, workers=1, select=None):
+    """
+    Load rules in batches before they are consumed. The data of each rule
+    in a batch is fetched concurrently, then the elements referenced by
+    the batch that are not yet known to names. Rules are returned in the
+    order provided. With a single worker, rules are returned as is and
+    loaded when consumed.
+    
+    :param rules: iterable of rules
+    :param ElementNames names: shared element names
+    :param list expand: cells that are expanded
+    :param int workers: number of concurrent requests
+    :param select: optional callable, if provided only elements of rules
+        for which it returns True are fetched
+    :rtype: generator
+    """
+    if workers <= 1:
+        for rule in rules:
+            yield rule
+        return
+    
+    rules = iter(rules)
+    while True:
+        batch = list(islice(rules, workers * 50))
+        if not batch:
+            return
+        run_concurrent(lambda rule: rule.data, batch, workers)
+        names.prefetch([href for rule in batch
+            if select is None or select(rule)
+            for href in rule_hrefs(rule, expand)], workers)
+        for rule in batch:
+            yield rule
+
+
+def to_yaml(rule, expand=None, names=None):
+    if names is None:
+        names = ElementNames()
+    
     _rule = {
         'name': rule.name, 'tag': rule.tag,
         'is_disabled': rule.is_disabled,
@@ -193,14 +386,16 @@ def to_yaml(rule, expand=None):
         else:
             if expand and field in expand:
                 tmp = {}
-                for entry in getattr(rule, field).all():
-                    element_type = entry.typeof
-                    if entry.typeof in engine_type:
+                for href in getattr(rule, field).all_as_href():
+                    entry = names.get(href)
+                    if entry is None:
+                        continue
+                    name, element_type = entry
+                    if element_type in engine_type:
                         element_type = 'engine'
-                    elif 'alias' in entry.typeof:
+                    elif 'alias' in element_type:
                         element_type = 'alias'
-                    tmp.setdefault(element_type, []).append(
-                        entry.name)
+                    tmp.setdefault(element_type, []).append(name)
             else:
                 tmp = getattr(rule, field).all_as_href()
             _rule[field] = tmp
@@ -216,7 +411,8 @@ def to_yaml(rule, expand=None):
     
     auth_options = {
         'require_auth': rule.authentication_options.require_auth,
-        'methods': [m.name for m in rule.authentication_options.methods]}
+        'methods': [names.name(method) for method in
+            rule.authentication_options.get('methods') or []]}
     for user in rule.authentication_options.users:
         if 'user_group' in user.typeof:
             auth_options.setdefault('groups', []).append(user.unique_id)
@@ -226,16 +422,123 @@ def to_yaml(rule, expand=None):
     _rule.update(authentication_options=auth_options)
     
     if rule.action.action in ('enforce_vpn', 'forward_vpn', 'apply_vpn'):
-        if rule.action.vpn:
-            _rule.update(vpn_policy=rule.action.vpn.name)
+        if rule.action.get('vpn'):
+            _rule.update(vpn_policy=names.name(rule.action.get('vpn')))
         else:
             _rule.update(mobile_vpn=rule.action.mobile_vpn)
     elif rule.action.action == 'jump':
-        _rule.update(sub_policy=rule.action.sub_policy.name)
+        _rule.update(sub_policy=names.name(rule.action.get('sub_policy')))
     _rule.update(connection_tracking=rule.action.connection_tracking_options.data)
     return _rule
 
 
+def rule_window(policy, start=None, end=None):
+    """
+    Rules of the policy from position start to end, both inclusive and
+    starting at 1. Rules are not kept by the caller, so the full rule
+    data is loaded per rule as it is consumed.
+    
+    :param FirewallPolicy policy: policy reference
+    :param int start: first rule position
+    :param int end: last rule position
+    :rtype: generator
+    """
+    return islice(policy.fw_ipv4_access_rules, (start or 1) - 1, end)
+
+
+def load_export(path):
+    """
+    Load rules written by write_rules, in json or yaml format
+    
+    :param str path: path of the file
+    :return: rules by tag without revision, in export order
+    :rtype: OrderedDict
+    """
+    with open(os.path.expanduser(path)) as f:
+        content = f.read()
+    if content.lstrip().startswith('-'):
+        import yaml
+        rules = yaml.safe_load(content) or []
+    else:
+        rules = [json.loads(line) for line in content.splitlines() if line.strip()]
+    return OrderedDict(
+        (str(rule.get('tag')).split('.')[0], rule) for rule in rules)
+
+
+def diff_rules(rules, previous, names, delta, expand=None, workers=1):
+    """
+    Compare rules to a previous export by tag. The tag of a rule ends
+    with its revision, which changes when the rule is modified. Only
+    rules that are new or have a different revision are converted and
+    have their referenced elements fetched. Added and changed rules, and
+    the name and tag of removed rules, are added to delta.
+    
+    :param rules: iterable of rules
+    :param OrderedDict previous: rules of the previous export by tag
+    :param ElementNames names: shared element names
+    :param dict delta: dict with added, changed and removed lists and
+        an unchanged count
+    :param list expand: cells that are expanded
+    :param int workers: number of concurrent requests
+    :return: every rule in export format, re-using the previous export
+        for unchanged rules
+    :rtype: generator
+    """
+    def modified(rule):
+        old = previous.get(rule.tag.split('.')[0])
+        return old is None or old.get('tag') != rule.tag
+    
+    seen = set()
+    for rule in fetch_rules(rules, names, expand, workers, select=modified):
+        key = rule.tag.split('.')[0]
+        seen.add(key)
+        if not modified(rule):
+            delta['unchanged'] += 1
+            yield previous[key]
+            continue
+        current = to_yaml(rule, expand, names)
+        delta['changed' if key in previous else 'added'].append(current)
+        yield current
+    
+    delta['removed'].extend(
+        {'name': rule.get('name'), 'tag': rule.get('tag')}
+        for key, rule in previous.items() if key not in seen)
+
+
+def write_rules(path, rules, output_format='json'):
+    """
+    Write rules to a file as they are provided. With json, each rule is
+    a JSON document on a single line. With yaml, each rule is an item of
+    a YAML list. Rules are written to a temporary file that replaces the
+    file at path once all rules are written.
+    
+    :param str path: path of the file
+    :param rules: iterable of rule dicts
+    :param str output_format: json or yaml
+    :return: number of rules written
+    :rtype: int
+    """
+    if output_format == 'yaml':
+        import yaml
+        dump = lambda rule: yaml.safe_dump([rule], default_flow_style=False)
+    else:
+        dump = lambda rule: json.dumps(rule) + '\n'
+    
+    path = os.path.abspath(os.path.expanduser(path))
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    count = 0
+    try:
+        with os.fdopen(fd, 'w') as f:
+            for rule in rules:
+                f.write(dump(rule))
+                count += 1
+        os.rename(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+    return count
+
+
 expands = ('sources', 'destinations', 'services')
 
         
@@ -243,22 +546,41 @@ class FirewallRuleFacts(StonesoftModuleBase):
     def __init__(self):
         
         self.module_args = dict(
-            filter=dict(type='str', required=True),
+            filter=dict(type='str'),
+            policies=dict(type='list'),
+            match_all=dict(type='bool', default=False),
             expand=dict(type='list', default=[]),
             search=dict(type='str'),
-            rule_range=dict(type='str')
+            rule_range=dict(type='str'),
+            workers=dict(type='int', default=1),
+            previous_export=dict(type='str'),
+            output_file=dict(type='str'),
+            output_format=dict(type='str', default='json', choices=['json', 'yaml'])
         )
     
         self.expand = None
         self.search = None
         self.limit = None
         self.filter = None
+        self.policies = None
+        self.match_all = None
         self.as_yaml = None
         self.exact_match = None
         self.case_sensitive = None
+        self.workers = None
+        self.previous_export = None
+        self.output_file = None
+        self.output_format = None
         
         mutually_exclusive = [
             ['search', 'rule_range'],
+            ['previous_export', 'search'],
+            ['previous_export', 'rule_range'],
+            ['filter', 'policies'],
+        ]
+        
+        required_one_of = [
+            ['filter', 'policies']
         ]
         
         self.results = dict(
@@ -267,7 +589,7 @@ class FirewallRuleFacts(StonesoftModuleBase):
             )
         )
         super(FirewallRuleFacts, self).__init__(self.module_args, is_fact=True,
-            mutually_exclusive=mutually_exclusive)
+            mutually_exclusive=mutually_exclusive, required_one_of=required_one_of)
 
     def exec_module(self, **kwargs):
         for name, value in kwargs.items():
@@ -278,50 +600,117 @@ class FirewallRuleFacts(StonesoftModuleBase):
                 self.fail(msg='Invalid expandable attribute: %s provided. Valid '
                     'options are: %s'  % (attr, expands))
         
-        rules = []
+        if self.previous_export and not self.as_yaml:
+            self.fail(msg='as_yaml is required when using previous_export')
+        
         try:
-            policy = self.search_by_type(FirewallPolicy)
-            if not policy:
+            if self.policies:
+                policies = []
+                for name in self.policies:
+                    policy = FirewallPolicy.objects.filter(name, exact_match=True).first()
+                    if not policy:
+                        self.fail(msg='Policy specified could not be found: %s' % name)
+                    policies.append(policy)
+            elif self.match_all and any(char in self.filter for char in '*?['):
+                policies = [policy for policy in FirewallPolicy.objects.all()
+                    if fnmatch.fnmatchcase(policy.name, self.filter)]
+            else:
+                policies = self.search_by_type(FirewallPolicy)
+            
+            if not policies:
                 self.fail(msg='Policy specified could not be found: %s' % self.filter)
-            elif len(policy) > 1:
+            elif len(policies) > 1 and not (self.policies or self.match_all):
                 self.fail(msg='Multiple policies found with the given search filter: %s '
-                    'Use exact_match or case_sensitive to narrow the search' % 
-                    [p.name for p in policy])
-    
-            policy = policy.pop()
+                    'Use exact_match or case_sensitive to narrow the search, or match_all '
+                    'to retrieve all matching policies' % [p.name for p in policies])
+            elif len(policies) > 1:
+                for path in (self.output_file, self.previous_export):
+                    if path and '{policy}' not in path:
+                        self.fail(msg='output_file and previous_export must contain '
+                            '{policy} when retrieving multiple policies')
             
-            if self.search:
-                result = policy.search_rule(self.search)
-            elif self.rule_range:
-                try:
-                    start, end = map(int, self.rule_range.split('-'))
-                    result= [x for x in policy.fw_ipv4_access_rules][start-1:end]
-                except ValueError:
-                    raise SMCException('Value of rule range was invalid. Rule ranges '
-                        'must be a string with numeric only values, got: %s' %
-                        self.rule_range)
-            else:
-                result = policy.fw_ipv4_access_rules
+            # Policies are exported concurrently, sharing the workers and
+            # the element names fetched for any of the policies
+            names = ElementNames()
+            concurrent = min(max(self.workers, 1), len(policies))
+            workers = max(self.workers // concurrent, 1)
+            size_session_pool(concurrent * workers)
             
-            if self.as_yaml:
-                rules = [to_yaml(rule, self.expand) for rule in result]
-            else:
-                # No order for since rules could be sliced or searched
-                if self.search or self.rule_range:
-                    rules = [{'name': rule.name, 'type': rule.typeof} for rule in result]
-                else:
-                    rules = [{'name': rule.name, 'type': rule.typeof, 'pos': num}
-                              for num, rule in enumerate(result, 1)]
+            self.results['ansible_facts']['firewall_rule'].extend(run_concurrent(
+                lambda policy: self.export(policy, names, workers),
+                policies, concurrent))
         
         except SMCException as err:
             self.fail(msg=str(err), exception=traceback.format_exc())
-        
-        firewall_rule = {
-            'policy': policy.name,
-            'rules': rules}
+        except (IOError, OSError, ValueError) as err:
+            self.fail(msg='Failed reading or writing rules: %s' % str(err))
     
-        self.results['ansible_facts']['firewall_rule'].append(firewall_rule)
         return self.results
+    
+    def export(self, policy, names, workers=1):
+        """
+        Retrieve the rules of a single policy
+        
+        :param FirewallPolicy policy: policy reference
+        :param ElementNames names: element names shared between policies
+        :param int workers: number of concurrent requests for this policy
+        :return: facts for the policy
+        :rtype: dict
+        """
+        output_file = previous_export = None
+        if self.output_file:
+            output_file = self.output_file.replace('{policy}', policy.name)
+        if self.previous_export:
+            previous_export = self.previous_export.replace('{policy}', policy.name)
+        
+        if self.search:
+            result = policy.search_rule(self.search)
+        elif self.rule_range:
+            try:
+                start, end = map(int, self.rule_range.split('-'))
+            except ValueError:
+                raise SMCException('Value of rule range was invalid. Rule ranges '
+                    'must be a string with numeric only values, got: %s' %
+                    self.rule_range)
+            result = rule_window(policy, start, end)
+        else:
+            result = rule_window(policy)
+        
+        # Rules are converted as they are consumed, elements referenced
+        # by the rules are only fetched once
+        delta = dict(added=[], changed=[], removed=[], unchanged=0)
+        if previous_export:
+            rules = diff_rules(result, load_export(previous_export), names,
+                delta, self.expand, workers)
+        elif self.as_yaml:
+            rules = (to_yaml(rule, self.expand, names) for rule in
+                fetch_rules(result, names, self.expand, workers))
+        else:
+            # No order for since rules could be sliced or searched
+            if self.search or self.rule_range:
+                rules = ({'name': rule.name, 'type': rule.typeof} for rule in result)
+            else:
+                rules = ({'name': rule.name, 'type': rule.typeof, 'pos': num}
+                          for num, rule in enumerate(result, 1))
+        
+        if output_file:
+            firewall_rule = {
+                'policy': policy.name,
+                'output_file': output_file,
+                'count': write_rules(output_file, rules, self.output_format)}
+        elif previous_export:
+            # Only the changes are returned
+            firewall_rule = {
+                'policy': policy.name,
+                'count': sum(1 for _ in rules)}
+        else:
+            firewall_rule = {
+                'policy': policy.name,
+                'rules': list(rules)}
+        
+        if previous_export:
+            firewall_rule.update(delta)
+        return firewall_rule
         
         
 def main():
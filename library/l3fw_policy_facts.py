@@ -73,12 +73,6 @@ policies:
 from ansible.module_utils.stonesoft_util import StonesoftModuleBase
 
 
-try:
-    from smc.policy.layer3 import FirewallPolicy
-except ImportError:
-    pass
-
-
 def policy_dict_from_obj(element):
     """
     Resolve the category to the supported types and return a dict
@@ -119,6 +113,8 @@ class FWPolicyFacts(StonesoftModuleBase):
         super(FWPolicyFacts, self).__init__({}, is_fact=True)
 
     def exec_module(self, **kwargs):
+        from smc.policy.layer3 import FirewallPolicy
+        
         for name, value in kwargs.items():
             setattr(self, name, value)
         
@@ -591,13 +591,15 @@ class NetworkElement(StonesoftModuleBase):
         :param dict pending_elements: elements waiting to be created
         :return: None
         """
+        existing = {}
         for group in groups:
             members = group.get('group', {}).get('members', {})
             members = {} if members is None else members
             for typeof, member in members.items():
                 for name in member:
                     if name not in pending_elements.get(typeof, set()):
-                        self.cache._add_entry(typeof, name)
+                        existing.setdefault(typeof, []).append(name)
+        self.cache.add(existing)
     
     def enum_netlink_members(self, netlinks, pending_elements):
         """
@@ -630,9 +632,8 @@ class NetworkElement(StonesoftModuleBase):
             if gateway.get('name') not in pending_elements.get(gateway.get('type'), set()):
                 self.cache._add_entry(gateway.get('type'), gateway.get('name'))
             
-            for network in networks:
-                if network not in pending_elements.get('network', set()):
-                    self.cache._add_entry('network', network)
+            self.cache.add({'network': [network for network in networks
+                if network not in pending_elements.get('network', set())]})
 
 
 def main():
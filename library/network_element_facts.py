@@ -133,18 +133,19 @@ from ansible.module_utils.stonesoft_util import (
     StonesoftModuleBase,
     element_type_dict,
     ro_element_type_dict,
+    element_types,
+    ro_element_types,
     element_dict_from_obj)
 
 
-ELEMENT_TYPES = element_type_dict()
-ELEMENT_TYPES.update(ro_element_type_dict())
+ELEMENT_TYPES = list(element_types) + list(ro_element_types)
 
     
 class NetworkElementFacts(StonesoftModuleBase):
     def __init__(self):
         
         self.module_args = dict(
-            element=dict(type='str', choices=list(ELEMENT_TYPES.keys())),
+            element=dict(type='str', choices=ELEMENT_TYPES),
             expand=dict(type='list', default=[])
         )
         self.element = None
@@ -165,6 +166,9 @@ class NetworkElementFacts(StonesoftModuleBase):
         for name, value in kwargs.items():
             setattr(self, name, value)
         
+        type_dict = element_type_dict()
+        type_dict.update(ro_element_type_dict())
+        
         for attr in self.expand:
             if attr not in ('group',):
                 self.fail(msg='Invalid expandable attribute: %s provided. Valid '
@@ -172,13 +176,13 @@ class NetworkElementFacts(StonesoftModuleBase):
         
         # Search by specific element type
         if self.element:
-            result = self.search_by_type(ELEMENT_TYPES.get(self.element)['type'])
+            result = self.search_by_type(type_dict.get(self.element)['type'])
         else:
             self.element = 'network_elements'
             result = self.search_by_context()
         
         if self.filter:
-            elements = [element_dict_from_obj(element, ELEMENT_TYPES, self.expand) for element in result]
+            elements = [element_dict_from_obj(element, type_dict, self.expand) for element in result]
         else:
             elements = [{'name': element.name, 'type': element.typeof} for element in result]
         
@@ -19,13 +19,34 @@ description:
     facts, you can determine from the pending_changes key whether a policy refresh
     if required. In addition, specifying the policy in the playbook forces the
     specified policy to be deployed.
+  - Policy can be deployed to a single engine, or to a list of engines or all
+    engines matching a filter. When deploying to multiple engines, the tasks are
+    started and monitored concurrently and the status of each engine is returned.
 
 version_added: '2.5'
 
 options:
   name:
     description:
-      - Name of the engine to deploy policy on
+      - Name of the engine to deploy policy on. One of I(name), I(engines) or
+        I(filter) is required
+  engines:
+    description:
+      - List of engine names to deploy policy on. Each name must match an engine
+        exactly
+    type: list
+  filter:
+    description:
+      - Deploy policy on all engines with a name containing this filter. Shell
+        style wildcards (C(*), C(?), C([])) can be used to match the full name
+        instead
+    type: str
+  workers:
+    description:
+      - Maximum number of engines with a policy task in progress at the same time.
+        When an engine task finishes, the task of the next engine is started
+    type: int
+    default: 1
   policy:
     description:
       - A policy to deploy. If the engine does not have an existing policy
@@ -34,14 +55,30 @@ options:
     type: str
   sleep:
     description:
-      - Amount of time to sleep between checking the task status
+      - Time unit used with I(max_tries) to limit how long the task is monitored.
+        The task status is first checked after I(min_sleep) and the interval is
+        doubled after each check until it reaches I(max_sleep). A random jitter
+        of up to a quarter of the interval is applied so tasks started together
+        are not checked at the same time
     type: int
     default: 3 sec
+  min_sleep:
+    description:
+      - Amount of time to sleep before the first check of the task status. Set
+        this to the same value as I(max_sleep) to check the status at a fixed
+        interval
+    type: float
+    default: 1
+  max_sleep:
+    description:
+      - Maximum amount of time to sleep between checks of the task status
+    type: float
+    default: 30
   max_tries:
     description:
-      - Max number of times to loop through status checks. In case the policy
-        is in 'wait' status (i.e. no connectivity to engine), this will only
-        block for max_tries * sleep
+      - The task is monitored for at most max_tries * sleep seconds, so in case
+        the policy is in 'wait' status (i.e. no connectivity to engine), this will
+        only block for max_tries * sleep
     type: int
     default: 36
   wait_for_finish:
@@ -49,6 +86,44 @@ options:
       - Whether to wait for the task to finish before returning
     type: bool
     default: true
+  only_if_pending:
+    description:
+      - Only deploy policy on engines that have pending changes, or that do not
+        have the policy specified in I(policy) installed. Other engines are skipped
+        and returned in I(skipped). Engines that do not support pending changes
+        always have their policy deployed
+    type: bool
+    default: false
+  rollout:
+    description:
+      - Deploy policy on the engines in successive waves. Each wave is started only
+        when all tasks of the previous wave have finished, and the rollout is stopped
+        when the number of failed engines exceeds the failure budget. Engines that
+        were not started are returned with status C(cancelled). Requires
+        I(wait_for_finish)
+    type: dict
+    suboptions:
+      canary:
+        description:
+          - Names of engines deployed first, as a wave of their own. The rollout is
+            stopped if any canary engine fails, regardless of I(failure_budget)
+        type: list
+      waves:
+        description:
+          - Number of engines in each wave, in order. The last size is repeated for
+            the remaining engines. By default all engines are in a single wave
+        type: list
+      max_parallel:
+        description:
+          - Maximum number of engines of a wave with a task in progress at the same
+            time. Defaults to I(workers)
+        type: int
+      failure_budget:
+        description:
+          - Number of failed engines tolerated over the whole rollout. An engine has
+            failed if its task failed, timed out or could not be started
+        type: int
+        default: 0
 
 extends_documentation_fragment: stonesoft
 
@@ -83,126 +158,417 @@ EXAMPLES = '''
       wait_for_finish: yes
       max_tries: 10
       sleep: 3
+
+- name: Refresh policy on all branch firewalls, 25 engines at a time
+  hosts: localhost
+  gather_facts: no
+  tasks:
+  - name: Refresh policy on engines matching the filter
+    policy_push:
+      filter: branch-*
+      workers: 25
+      max_tries: 100
+      sleep: 3
+
+- name: Upload policy only to engines with pending changes or another policy
+  hosts: localhost
+  gather_facts: no
+  tasks:
+  - name: Upload policy if required
+    policy_push:
+      engines:
+        - fw1
+        - fw2
+      policy: fwpolicy
+      only_if_pending: yes
+
+- name: Refresh policy on a canary firewall, then on 10 and 50 engines at a time
+  hosts: localhost
+  gather_facts: no
+  tasks:
+  - name: Staged policy refresh
+    policy_push:
+      filter: branch-*
+      rollout:
+        canary:
+          - branch-lab
+        waves: [10, 50]
+        max_parallel: 25
+        failure_budget: 2
 '''
 
 RETURN = '''
 failed:
-  description: Whether or not the task failed or not
+  description: Whether or not the task failed or not. When deploying on multiple
+    engines, this is true if the task of any engine could not be started, failed
+    or timed out
   returned: always
   type: bool
 msg:
   description: Message returned when policy task returns
   return: always
   type: str
+engines:
+  description: Result of the policy task for each engine
+  returned: always
+  type: list
+  sample: [
+    {
+        "duration": 42.3,
+        "msg": "Upload succeeded",
+        "name": "branch-1",
+        "status": "success"
+    },
+    {
+        "duration": 108.1,
+        "msg": "Waiting for policy installation...",
+        "name": "branch-2",
+        "status": "timeout"
+    }]
+  contains:
+    wave:
+      description: Wave of the engine, starting at 1, when I(rollout) is set
+      type: int
+skipped:
+  description: Engines skipped when I(only_if_pending) is set because they have no
+    pending changes and the policy is already installed
+  returned: always
+  type: list
+  sample: [
+    {
+        "duration": 0.4,
+        "msg": "No pending changes and policy fwpolicy is installed",
+        "name": "branch-3",
+        "status": "skipped"
+    }]
 '''
 
 
+import time
+import random
+import fnmatch
+import threading
+from collections import Counter
 import traceback
-from ansible.module_utils.stonesoft_util import StonesoftModuleBase
+from ansible.module_utils.stonesoft_util import (
+    StonesoftModuleBase, run_concurrent, size_session_pool)
 
 
 try:
     from smc.core.engine import Engine
-    from smc.api.exceptions import SMCException
+    from smc.base.collection import Search
+    from smc.api.exceptions import SMCException, UnsupportedEngineFeature
 except ImportError:
     pass
 
 
+def backoff(initial, maximum):
+    """
+    Generate the intervals between status checks of a task. The interval
+    starts at initial and is doubled after each check up to maximum. Each
+    interval is randomly changed by up to a quarter either way so status
+    checks of tasks started at the same time are spread out.
+    
+    :param float initial: first interval in seconds
+    :param float maximum: maximum interval in seconds
+    :rtype: generator(float)
+    """
+    interval = min(initial, maximum)
+    while True:
+        yield random.uniform(interval * 0.75, interval * 1.25)
+        interval = min(interval * 2, maximum)
+
+
 class PolicyDeploy(StonesoftModuleBase):
     def __init__(self):
         
         self.module_args = dict(
-            name=dict(type='str', required=True),
+            name=dict(type='str'),
+            engines=dict(type='list'),
+            filter=dict(type='str'),
             policy=dict(type='str'),
             sleep=dict(default=3, type='int'),
+            min_sleep=dict(default=1, type='float'),
+            max_sleep=dict(default=30, type='float'),
             max_tries=dict(default=36, type='int'),
             wait_for_finish=dict(type='bool', default=True),
+            only_if_pending=dict(type='bool', default=False),
+            rollout=dict(type='dict', options=dict(
+                canary=dict(type='list'),
+                waves=dict(type='list'),
+                max_parallel=dict(type='int'),
+                failure_budget=dict(type='int', default=0))),
+            workers=dict(type='int', default=1)
         )
         
         self.name = None
+        self.engines = None
+        self.filter = None
         self.policy= None
         self.sleep = None
+        self.min_sleep = None
+        self.max_sleep = None
         self.max_tries = None
         self.wait_for_finish= None
+        self.only_if_pending = None
+        self.rollout = None
+        self.workers = None
+        
+        mutually_exclusive = [
+            ['name', 'engines', 'filter'],
+        ]
+        
+        required_one_of = [
+            ['name', 'engines', 'filter']
+        ]
         
         self.results = dict(
             failed=False,
-            msg=''
+            msg='',
+            engines=[],
+            skipped=[]
         )
-        super(PolicyDeploy, self).__init__(self.module_args)
+        super(PolicyDeploy, self).__init__(self.module_args,
+            mutually_exclusive=mutually_exclusive,
+            required_one_of=required_one_of)
     
-    def exec_module(self, **kwargs):
-        for name, value in kwargs.items():
-            setattr(self, name, value)
+    def find_engines(self):
+        """
+        Return the engines specified by name, engines or filter
+        
+        :rtype: list(Engine)
+        """
+        if self.name:
+            return [Engine.get(self.name)]
+        
+        if self.engines:
+            engines = []
+            for name in self.engines:
+                engine = Search.objects.context_filter('engine_clusters')\
+                    .filter(name, exact_match=True).first()
+                if not engine:
+                    self.fail(msg='Engine specified could not be found: %s' % name)
+                engines.append(engine)
+            return engines
+        
+        if any(char in self.filter for char in '*?['):
+            return [engine for engine in Search.objects.context_filter('engine_clusters')
+                if fnmatch.fnmatchcase(engine.name, self.filter)]
+        # The SMC filter also matches other fields such as the comment
+        return [engine for engine in Search.objects.context_filter('engine_clusters')
+            .filter(self.filter) if self.filter in engine.name]
+    
+    def is_pending(self, engine, installed_policy):
+        """
+        Whether policy needs to be deployed on the engine. This is the case
+        when the policy to upload is not the installed policy, or when the
+        engine has pending changes or cannot report them.
         
-        failed = False
+        :param Engine engine: engine to check
+        :param str installed_policy: name of the policy installed on the engine
+        :rtype: bool
+        """
+        if self.policy and not (installed_policy == self.policy or (installed_policy
+                and fnmatch.fnmatchcase(installed_policy, self.policy))):
+            return True
+        try:
+            return bool(engine.pending_changes.count())
+        except UnsupportedEngineFeature:
+            return True
+    
+    def push(self, engine):
+        """
+        Upload the policy or refresh the installed policy on the engine and
+        monitor the task until it finishes or max_tries is reached. Status
+        is one of success, failed, timeout or in_progress for tasks that
+        were started, skipped if only_if_pending is set and the engine has
+        no pending changes, or error if the task could not be started.
         
+        :param Engine engine: engine to deploy policy on
+        :return: name, status, duration and last message of the task
+        :rtype: dict
+        """
+        result = dict(name=engine.name, status='error', msg='')
+        start = time.time()
         try:
-            engine = Engine.get(self.name)
-            msg = ''
+            installed_policy = None
+            if self.only_if_pending or not self.policy:
+                installed_policy = engine.installed_policy
+            
+            if not self.policy and not installed_policy:
+                result.update(msg='Engine does not currently have a policy assigned, '
+                    'you must specify a policy to upload before refreshing policy.')
+                return result
+            
+            if self.only_if_pending and not self.is_pending(engine, installed_policy):
+                result.update(status='skipped',
+                    msg='No pending changes and policy %s is installed' % installed_policy)
+                return result
+            
             # If policy is defined, run an upload on the policy
             # TODO: Address situation where policy is queued for
             # uninitialized engine and attempted twice. This will
             # succeed but SMC 6.3 will return ''
             if self.policy:
-                if self.wait_for_finish:
-                    task = engine.upload(
-                        self.policy,
-                        timeout=self.sleep,
-                        wait_for_finish=True,
-                        max_tries=self.max_tries)
-                    
-                    while not task.done():
-                        task.wait(self.sleep)
-                    
-                    msg = task.last_message()
-                
-                else:
-                    task = engine.upload(self.policy)
-                    
-                    if task.task.in_progress:
-                        msg = 'Task upload currently in progress. Check the engine ' \
-                            'facts to determine if any pending changes remain.'
-                    else:
-                        msg ='Task did not report positive status when starting. ' \
-                            'Returned status was %s' % task.last_message()
-                        failed = True
-
-            else: # A refresh of already installed policy
-                if engine.installed_policy:
-                    if self.wait_for_finish:
-                        task = engine.refresh(
-                            timeout=self.sleep,
-                            wait_for_finish=True,
-                            max_tries=self.max_tries)
-                        
-                        while not task.done():
-                            task.wait(self.sleep)
-                    
-                        msg = task.last_message()
-                    else:
-                        if engine.installed_policy:
-                            task = engine.refresh()
-                            
-                            if task.task.in_progress:
-                                msg = 'Task refresh currently in progress. Check the engine ' \
-                                    'facts to determine if any pending changes remain.'
-                            else:
-                                msg ='Task did not report positive status when starting. ' \
-                                    'Returned status was %s' % task.last_message()
-                                failed = True
+                task = engine.upload(self.policy).task
+            else:
+                task = engine.refresh().task
+            
+            if not task.in_progress:
+                result.update(msg='Task did not report positive status when starting. '
+                    'Returned status was %s' % task.last_message)
+                return result
+            
+            if self.wait_for_finish:
+                # The task is monitored for at most max_tries * sleep seconds
+                deadline = start + self.max_tries * self.sleep
+                intervals = backoff(self.min_sleep, self.max_sleep)
+                while task.in_progress:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    time.sleep(min(next(intervals), remaining))
+                    task = task.update_status()
+            
+                if task.in_progress:
+                    result.update(status='timeout')
                 else:
-                    msg = 'Engine does not currently have a policy assigned, you must ' \
-                        'specify a policy to upload before refreshing policy.'
-                    failed = True
-                        
-
-            self.results['msg'] = msg
+                    result.update(status='success' if task.success else 'failed')
+                result.update(msg=task.last_message)
+            else:
+                result.update(status='in_progress',
+                    msg='Task %s currently in progress. Check the engine facts to '
+                        'determine if any pending changes remain.' % (
+                            'upload' if self.policy else 'refresh'))
+        
+        except SMCException as err:
+            result.update(msg=str(err))
+        finally:
+            result.update(duration=round(time.time() - start, 1))
+        return result
+    
+    def plan_waves(self, engines):
+        """
+        Split the engines in the waves of the rollout. Canary engines form
+        the first wave and the remaining engines are split by the wave sizes,
+        repeating the last size.
+        
+        :param list(Engine) engines: engines to deploy policy on
+        :rtype: list(list(Engine))
+        """
+        canary = self.rollout.get('canary') or []
+        missing = set(canary).difference(engine.name for engine in engines)
+        if missing:
+            self.fail(msg='Canary engines are not part of the engines to deploy '
+                'policy on: %s' % sorted(missing))
+        
+        try:
+            sizes = [int(size) for size in self.rollout.get('waves') or [len(engines)]]
+        except (TypeError, ValueError):
+            sizes = [0]
+        if any(size < 1 for size in sizes):
+            self.fail(msg='Rollout waves must be a list of positive integers, '
+                'received: %s' % self.rollout.get('waves'))
+        
+        waves = [[engine for engine in engines if engine.name in canary]]
+        remaining = [engine for engine in engines if engine.name not in canary]
+        while remaining:
+            size = sizes.pop(0) if len(sizes) > 1 else sizes[0]
+            waves.append(remaining[:size])
+            remaining = remaining[size:]
+        return [wave for wave in waves if wave]
+    
+    def staged_push(self, engine):
+        """
+        Push policy to an engine of a rollout wave, unless the failure budget
+        of the rollout has been exceeded while the wave was in progress.
+        
+        :param Engine engine: engine to deploy policy on
+        :rtype: dict
+        """
+        with self.lock:
+            if self.failures > self.budget:
+                return dict(name=engine.name, status='cancelled', msg='Rollout stopped',
+                    duration=0.0)
+        result = self.push(engine)
+        if result['status'] in ('failed', 'timeout', 'error'):
+            with self.lock:
+                self.failures += 1
+        return result
+    
+    def staged_rollout(self, engines):
+        """
+        Deploy policy on the engines wave by wave. Each wave runs up to
+        max_parallel engines concurrently and the next wave is started once
+        all of its tasks finished. The rollout stops when a canary engine
+        fails or the failed engines exceed the failure budget.
+        
+        :param list(Engine) engines: engines to deploy policy on
+        :return: results of each engine with the wave number
+        :rtype: list(dict)
+        """
+        budget = self.rollout.get('failure_budget') or 0
+        parallel = self.rollout.get('max_parallel') or self.workers
+        canary = self.rollout.get('canary')
+        
+        size_session_pool(parallel)
+        self.lock = threading.Lock()
+        self.failures = 0
+        results = []
+        stopped = False
+        for number, wave in enumerate(self.plan_waves(engines), 1):
+            if stopped:
+                wave_results = [dict(name=engine.name, status='cancelled',
+                    msg='Rollout stopped', duration=0.0) for engine in wave]
+            else:
+                # The canary wave does not tolerate any failure
+                self.budget = 0 if canary and number == 1 else budget
+                wave_results = run_concurrent(self.staged_push, wave, parallel)
+                stopped = self.failures > self.budget
+            for result in wave_results:
+                result.update(wave=number)
+            results.extend(wave_results)
+        return results
+    
+    def exec_module(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+        
+        try:
+            engines = self.find_engines()
+            if not engines:
+                self.fail(msg='No engines found matching filter: %s' % self.filter)
+            
+            if self.rollout is not None:
+                if not self.wait_for_finish:
+                    self.fail(msg='wait_for_finish is required for a rollout')
+                results = self.staged_rollout(engines)
+            else:
+                # Tasks of up to workers engines are in progress at the same time
+                # and are monitored concurrently
+                size_session_pool(self.workers)
+                results = run_concurrent(self.push, engines, self.workers)
 
         except SMCException as err:
             self.fail(msg=str(err), exception=traceback.format_exc())
         
-        self.results['failed'] = failed
+        self.results['engines'] = [result for result in results
+            if result['status'] != 'skipped']
+        self.results['skipped'] = [result for result in results
+            if result['status'] == 'skipped']
+        if self.name:
+            self.results['msg'] = results[0]['msg']
+        else:
+            self.results['msg'] = ', '.join('%s: %s' % (status, count) for status, count in
+                sorted(Counter(result['status'] for result in results).items()))
+        
+        # A single engine only fails if the task could not be started
+        failed = ('error',) if self.name else ('error', 'failed', 'timeout')
+        self.results['failed'] = any(result['status'] in failed for result in results)
+        if self.rollout is not None and self.failures > self.budget:
+            self.results['failed'] = True
+            self.results['msg'] = 'Rollout stopped after %s failed engines. %s' % (
+                self.failures, self.results['msg'])
         return self.results
     
 
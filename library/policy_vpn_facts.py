@@ -106,10 +106,6 @@ from ansible.module_utils.stonesoft_util import (
     format_element)
 
 
-try:
-    from smc.vpn.policy import PolicyVPN
-except ImportError:
-    pass
 
 
 def to_dict(vpn, expand=None):
@@ -203,6 +199,8 @@ class PolicyVPNFacts(StonesoftModuleBase):
         super(PolicyVPNFacts, self).__init__(self.module_args, is_fact=True)
 
     def exec_module(self, **kwargs):
+        from smc.vpn.policy import PolicyVPN
+        
         for name, value in kwargs.items():
             setattr(self, name, value)
         
@@ -125,14 +125,10 @@ route_map:
 
 from ansible.module_utils.stonesoft_util import StonesoftModuleBase
 
-try:
-    from smc.routing.route_map import RouteMap
-    from smc.core.engine import Engine
-except ImportError:
-    pass
-
 
 def to_yaml(rm):
+    from smc.core.engine import Engine
+    
     routemap = dict(
         name=rm.name,
         comment=rm.comment)
@@ -181,6 +177,8 @@ class RouteMapFacts(StonesoftModuleBase):
         super(RouteMapFacts, self).__init__({}, required_if=required_if, is_fact=True)
 
     def exec_module(self, **kwargs):
+        from smc.routing.route_map import RouteMap
+        
         for name, value in kwargs.items():
             setattr(self, name, value)
         
@@ -252,12 +252,6 @@ RETURN = '''
 from ansible.module_utils.stonesoft_util import StonesoftModuleBase, format_element
 
 
-try:
-    from smc.vpn.route import RouteVPN
-except ImportError:
-    pass
-
-
 def to_yaml(vpn):
     rbvpn = {'name': vpn.name,
              'enabled': vpn.enabled}
@@ -360,6 +354,8 @@ class RouteVPNFacts(StonesoftModuleBase):
                                             is_fact=True)
 
     def exec_module(self, **kwargs):
+        from smc.vpn.route import RouteVPN
+        
         for name, value in kwargs.items():
             setattr(self, name, value)
 
@@ -64,13 +64,6 @@ import traceback
 from ansible.module_utils.stonesoft_util import StonesoftModuleBase
 
 
-try:
-    from smc.core.engine import Engine
-    from smc.api.exceptions import SMCException
-except ImportError:
-    pass
-
-
 def route_dict_from_obj(element):
     return dict(
         route_gateway=getattr(element, 'route_gateway', None),
@@ -98,6 +91,9 @@ class RoutingFacts(StonesoftModuleBase):
         super(RoutingFacts, self).__init__(self.module_args)
 
     def exec_module(self, **kwargs):
+        from smc.core.engine import Engine
+        from smc.api.exceptions import SMCException
+        
         for name, value in kwargs.items():
             setattr(self, name, value)
         
@@ -586,14 +586,16 @@ class ServiceElement(StonesoftModuleBase):
                     to_be_created.setdefault(typeof, set()).add(
                         values.get('name'))
 
-        cache = Cache()
+        existing = {}
         for group in groups:
             for _, values in group.items():
                 members = {} if values.get('members') is None else values['members']
                 for typeof, member in members.items():
                     for name in member:
                         if name not in to_be_created.get(typeof, set()):
-                            cache._add_entry(typeof, name)
+                            existing.setdefault(typeof, []).append(name)
+        cache = Cache()
+        cache.add(existing)
         return cache
    
 
@@ -131,18 +131,19 @@ from ansible.module_utils.stonesoft_util import (
     StonesoftModuleBase,
     service_type_dict,
     element_dict_from_obj,
-    ro_service_type_dict)
+    ro_service_type_dict,
+    service_types,
+    ro_service_types)
 
 
-ELEMENT_TYPES = service_type_dict()
-ELEMENT_TYPES.update(ro_service_type_dict())
+ELEMENT_TYPES = list(service_types) + list(ro_service_types)
 
 
 class ServiceFacts(StonesoftModuleBase):
     def __init__(self):
         
         self.module_args = dict(
-            element=dict(type='str', choices=list(ELEMENT_TYPES.keys())),
+            element=dict(type='str', choices=ELEMENT_TYPES),
             expand=dict(type='list')
         )
     
@@ -162,15 +163,18 @@ class ServiceFacts(StonesoftModuleBase):
         for name, value in kwargs.items():
             setattr(self, name, value)
         
+        type_dict = service_type_dict()
+        type_dict.update(ro_service_type_dict())
+        
         # Search by specific element type
         if self.element:
-            result = self.search_by_type(ELEMENT_TYPES.get(self.element)['type'])
+            result = self.search_by_type(type_dict.get(self.element)['type'])
         else:
             self.element = 'services_and_applications'
             result = self.search_by_context()
         
         if self.filter:
-            elements = [element_dict_from_obj(element, ELEMENT_TYPES, self.expand) for element in result]
+            elements = [element_dict_from_obj(element, type_dict, self.expand) for element in result]
         else:
             elements = [{'name': element.name, 'type': element.typeof} for element in result]
         
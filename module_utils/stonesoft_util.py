@@ -2,27 +2,359 @@
 Base spec for Stonesoft Management Center connections. This is a session
 that will be re-used for multiple operations against the management
 server.
+
+smc-python is imported on first use rather than when this module is
+imported, as every task runs in a new interpreter.
 """
+import os
+import json
+import time
+import hashlib
 import inspect
+import tempfile
+import importlib
 import traceback
 from ansible.module_utils.basic import AnsibleModule
 
 
-try:
+# Set once smc-python has been imported successfully by import_smc
+HAS_LIB = False
+
+
+def import_smc():
+    """
+    Import smc-python and its dependencies. A package that is installed
+    but cannot be imported, i.e. missing requests or a smc-python version
+    not supported by this python version, is reported as unavailable.
+    
+    :return: whether smc-python is available
+    :rtype: bool
+    """
+    global HAS_LIB
+    if not HAS_LIB:
+        try:
+            import requests
+            from smc import session
+            from smc.base.model import Element
+        except (ImportError, AttributeError):
+            return False
+        HAS_LIB = True
+    return True
+
+
+class PersistentCache(object):
+    """
+    Name to href mapping of resolved elements stored on disk so it can
+    be shared across module invocations. Each ansible task runs in a new
+    process, so without this the same elements are resolved again for
+    every task. Entries are keyed by the SMC URL and domain and expire
+    after `ttl` seconds. Elements are rebuilt from the stored href and
+    type without making a query to the SMC.
+    
+    :param str path: directory where cache files are stored
+    :param int ttl: time in seconds an entry is considered valid
+    :param str url: SMC URL of the current session
+    :param str domain: domain of the current session
+    """
+    def __init__(self, path, ttl, url, domain=None):
+        key = hashlib.sha1('{}|{}'.format(
+            url, domain or 'Shared Domain').encode('utf-8')).hexdigest()
+        self.path = os.path.expanduser(path)
+        self.filename = os.path.join(self.path, 'smc_cache_{}.json'.format(key))
+        self.ttl = ttl
+        self.entries = self._load() # typeof: {name: {href, type, timestamp}}
+        self.changes = {} # (typeof, name): entry, or None if invalidated
+    
+    def _load(self):
+        """
+        Read the cache file. A file that cannot be read or does not have
+        the expected structure is treated as empty.
+        
+        :rtype: dict
+        """
+        try:
+            with open(self.filename) as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(entries, dict) or not all(
+            isinstance(values, dict) and all(
+                isinstance(entry, dict) and 'href' in entry and 'type' in entry
+                for entry in values.values())
+            for values in entries.values()):
+            return {}
+        return entries
+    
+    def get(self, typeof, name):
+        """
+        Get element from the persistent cache
+        
+        :param str typeof: typeof element as used by Cache
+        :param str name: name of element
+        :rtype: element or None
+        """
+        entry = self.entries.get(typeof, {}).get(name)
+        if entry and time.time() - entry.get('timestamp', 0) < self.ttl:
+            from smc.base.model import lookup_class
+            return lookup_class(entry['type'])(
+                name=name, href=entry['href'], type=entry['type'])
+    
+    def set(self, typeof, element):
+        """
+        Store the element href and type for the given typeof
+        
+        :param str typeof: typeof element as used by Cache
+        :param Element element: resolved element
+        """
+        entry = dict(
+            href=element.href,
+            type=element.typeof,
+            timestamp=time.time())
+        self.entries.setdefault(typeof, {})[element.name] = entry
+        self.changes[(typeof, element.name)] = entry
+    
+    def invalidate(self, name, typeof=None):
+        """
+        Remove entries matching name. Entries are stored by the typeof
+        used to resolve them, which may differ from the element type
+        (i.e. 'engine'), so both are checked.
+        
+        :param str name: name of element
+        :param str typeof: element type, or None to match any type
+        """
+        for key, values in self.entries.items():
+            entry = values.get(name)
+            if entry and (typeof is None or typeof in (key, entry['type'])):
+                values.pop(name)
+                self.changes[(key, name)] = None
+    
+    def save(self):
+        """
+        Write changes to disk. The file is re-read before writing and only
+        the entries set or invalidated by this process are applied to it, so
+        changes made by other processes since this file was loaded are kept.
+        The file is replaced atomically.
+        """
+        if not self.changes:
+            return
+        current = self._load()
+        for (key, name), entry in self.changes.items():
+            if entry is None:
+                current.get(key, {}).pop(name, None)
+            else:
+                current.setdefault(key, {})[name] = entry
+        now = time.time()
+        for key in list(current):
+            current[key] = {name: entry for name, entry in current[key].items()
+                if now - entry.get('timestamp', 0) < self.ttl}
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(current, f)
+            os.rename(tmp, self.filename)
+            self.changes = {}
+        except (IOError, OSError):
+            pass
+
+
+class SessionStore(object):
+    """
+    Authenticated SMC session stored on disk so it can be re-used by
+    subsequent tasks instead of logging in and out for every module run.
+    The session cookies and entry points are stored, keyed by the SMC URL,
+    domain, API version and a hash of the credentials so a session is only
+    re-used by the same account. Credentials are never written to disk, they
+    are provided by the module on each run so an expired session can still
+    be refreshed by smc-python.
+    
+    :param str path: directory where session files are stored
+    :param dict login_params: login parameters as accepted by session.login
+    """
+    credentials = ('api_key', 'login', 'pwd')
+    
+    def __init__(self, path, login_params):
+        self.login_params = login_params
+        identity = hashlib.sha1('|'.join(
+            '{}'.format(login_params.get(credential))
+            for credential in self.credentials).encode('utf-8')).hexdigest()
+        key = hashlib.sha1('{}|{}|{}|{}'.format(
+            login_params.get('url'),
+            login_params.get('domain') or 'Shared Domain',
+            login_params.get('api_version') or 'latest',
+            identity).encode('utf-8')).hexdigest()
+        self.path = os.path.expanduser(path)
+        self.filename = os.path.join(self.path, 'smc_session_{}.json'.format(key))
+        self.data = None
+    
+    def restore(self, smc_session):
+        """
+        Restore the stored session into the smc-python session and validate
+        it with a single request against an authenticated entry point.
+        
+        :param Session smc_session: smc-python session to restore into
+        :return: True if the session was restored and is valid
+        :rtype: bool
+        """
+        import requests
+        from smc.api.entry_point import Resource
+        from smc.api.exceptions import SMCException
+        try:
+            with open(self.filename) as f:
+                self.data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        
+        # A truncated or foreign file is handled as if it did not exist
+        try:
+            _session = requests.session()
+            _session.cookies.update(self.data['cookies'])
+            _session.verify = self.data['verify']
+            
+            params = dict(self.data['params'])
+            entry_points = [dict(entry) for entry in self.data['entry_points']]
+            name = self.data['name']
+        except (KeyError, TypeError, ValueError, AttributeError):
+            self.data = None
+            return False
+        
+        params.update({k: v for k, v in self.login_params.items()
+            if k in self.credentials and v is not None})
+        
+        smc_session._params = params
+        smc_session._session = _session
+        smc_session._resource = Resource(entry_points)
+        try:
+            response = _session.get(
+                smc_session.entry_points.get('system'),
+                timeout=smc_session.timeout)
+            valid = response.status_code == 200
+        except (requests.exceptions.RequestException, SMCException):
+            valid = False
+        
+        if not valid:
+            smc_session._params = {}
+            smc_session._session = None
+            smc_session._resource = None
+            self.clear()
+            return False
+        
+        # Register without resolving the session name which requires a query
+        smc_session.manager._sessions[name] = smc_session
+        return True
+    
+    def save(self, smc_session):
+        """
+        Store the session if it changed since it was restored. The file is
+        created with owner only permissions as it contains the session cookie.
+        
+        :param Session smc_session: active smc-python session
+        """
+        import requests
+        data = dict(
+            name=smc_session.manager._get_session_key(smc_session),
+            cookies=requests.utils.dict_from_cookiejar(smc_session.session.cookies),
+            verify=smc_session.session.verify,
+            params={k: v for k, v in smc_session._params.items()
+                if k not in self.credentials},
+            entry_points=list(smc_session.entry_points._entry_points))
+        
+        if data == self.data:
+            return
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path, 0o700)
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp, self.filename)
+        except (IOError, OSError, TypeError):
+            pass
+    
+    def clear(self):
+        """
+        Remove the stored session
+        """
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+
+def login_params(params):
+    """
+    Resolve the parameters that will be used to log in to the SMC from the
+    module parameters, falling back to ~.smcrc or the environment the same
+    way smc-python does.
+    
+    :param dict params: dict of the SMC credential information
+    :raises ConfigLoadError: credentials could not be loaded
+    :rtype: dict
+    """
+    from smc.api.exceptions import ConfigLoadError
+    from smc.api.configloader import load_from_file, load_from_environ
+    if params.get('smc_address') and params.get('smc_api_key'):
+        return dict(
+            url=params.get('smc_address'),
+            api_key=params.get('smc_api_key'),
+            api_version=params.get('smc_api_version'),
+            timeout=params.get('smc_timeout'),
+            domain=params.get('smc_domain'),
+            kwargs=params.get('smc_extra_args') or {})
+    elif params.get('smc_alt_filepath'):
+        return load_from_file(params['smc_alt_filepath'])
+    try:
+        return load_from_file()
+    except ConfigLoadError:
+        return load_from_environ()
+
+
+def size_session_pool(size):
+    """
+    Size the HTTP connection pool of the SMC session so size threads can
+    share its connections. Modules call this once with the total number of
+    threads they run, including nested run_concurrent calls, before
+    starting them. The adapter is only replaced if its pool is smaller.
+    
+    :param int size: total number of concurrent requests
+    """
     from smc import session
-    import smc.elements.network as network
-    import smc.elements.netlink as netlink
-    import smc.elements.group as group
-    import smc.elements.service as service
-    from smc.core.engine import Engine
-    from smc.base.collection import Search
-    from smc.elements.other import Category
-    from smc.api.exceptions import ConfigLoadError, SMCException, \
-        UserElementNotFound, ElementNotFound, DeleteElementFailed
-    HAS_LIB = True
-except ImportError:
-    HAS_LIB = False
+    if session.session is None:
+        return
+    from requests.adapters import HTTPAdapter, DEFAULT_POOLSIZE
+    adapter = session.session.get_adapter(session.url)
+    if getattr(adapter, '_pool_maxsize', DEFAULT_POOLSIZE) < size:
+        session.session.mount(session.url, HTTPAdapter(
+            pool_maxsize=size, max_retries=adapter.max_retries))
+
+
+def run_concurrent(func, items, workers=1):
+    """
+    Run func for each item on a bounded pool of threads and return the
+    results in the order of items. Exceptions raised by func are raised
+    in the caller. With a single worker, items are run in turn in the
+    calling thread. The connection pool of the SMC session is not changed,
+    see :func:`size_session_pool`.
+    
+    :param func: callable taking a single item
+    :param list items: items to process
+    :param int workers: maximum number of concurrent calls
+    :rtype: list
+    """
+    items = list(items)
+    workers = min(workers or 1, len(items))
+    if workers <= 1:
+        return [func(item) for item in items]
     
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
 
 class Cache(object):
     """
@@ -31,11 +363,23 @@ class Cache(object):
     is not intended to have a `get_or_create` logic, therefore when
     validating the existence of elements, you should check missing
     before continuing the playbook run.
+    
+    Elements are indexed by typeof and name, and secondarily by href
+    so lookups do not require walking the cached elements. If `store`
+    is set (see the `smc_cache` module option), resolved elements are
+    also loaded from and saved to a :class:`PersistentCache`.
+    
+    :param int workers: number of lookups run concurrently when adding
+        many entries. Results are merged into the cache in the calling
+        thread.
     """
+    store = None
     
-    def __init__(self):
+    def __init__(self, workers=1):
+        self.workers = workers
         self.missing = []
-        self.cache = {} # typeof: [Element1, Element2, ..]
+        self.cache = {} # typeof: {name: Element1, ..}, user_element by href
+        self.href_index = {} # href: Element
         
     def add_many(self, list_of_entries):
         """
@@ -45,74 +389,163 @@ class Cache(object):
                        {'host': [host1, host2]}
                        ...]
         Where the key is a valid 'typeof' (SMC entry point)
-        and value is a list of names to search
+        and value is a list of names to search. Names are grouped
+        by typeof before being resolved.
         """
+        pending = {}
         for elements in list_of_entries:
             for typeof, values in elements.items():
-                for name in values:
-                    self._add_entry(typeof, name)
+                pending.setdefault(typeof, []).extend(values)
+        self.add(pending)
                 
     def add(self, dict_of_entries):
         """
         Add entry as dict of list, format:
         
             element = {'network': [network1,network2]}
+        
+        When more than one name is pending for a given typeof, the
+        entry point is listed once and names are matched client side
+        instead of running a filter query per name. Each typeof is
+        resolved concurrently when `workers` is more than one.
         """
+        pending = [] # (typeof, names)
         for typeof, values in dict_of_entries.items():
+            names = []
             for name in values:
-                self._add_entry(typeof, name)
+                if name not in names and not self._cached(typeof, name):
+                    names.append(name)
+            if names:
+                pending.append((typeof, names))
+        
+        results = run_concurrent(
+            lambda entry: self._resolve(*entry), pending, self.workers)
+        for (typeof, names), found in zip(pending, results):
+            self._merge(typeof, names, found)
     
     def _add_user_entries(self, typeof, users):
-        # User elements are fetched by direct href
+        # User elements are fetched by direct href, with a single call
+        # per domain for all uids of that domain
         domain_dict = {}
         for user in users:
             _user, _domain = user.split(',domain=')
-            domain_dict.setdefault(_domain, []).append(_user)
+            uids = domain_dict.setdefault(_domain, [])
+            if _user not in uids:
+                uids.append(_user)
+        
+        from smc.base.collection import Search
+        from smc.api.exceptions import UserElementNotFound
         
         func = 'get_groups' if typeof == 'groups' else 'get_users'
-    
-        for domain, uids in domain_dict.items():
-            # Get domain first
+        
+        def find_users(domain):
+            # The domain call fails if any uid is not found, or may return
+            # fewer elements. Each uid is then fetched so the ones missing
+            # can be reported individually
             entry_point = 'external_ldap_user_domain' if domain != \
                 'InternalDomain' else 'internal_user_domain'
-            
             ldap = Search.objects.entry_point(entry_point)\
                 .filter(domain, exact_match=True).first()
-
+            if not ldap:
+                return entry_point, None, {}
+            
+            uids = domain_dict[domain]
+            try:
+                result = getattr(ldap, func)(uids)
+                if len(result) == len(uids):
+                    return entry_point, ldap, {uid: (element, None)
+                        for uid, element in zip(uids, result)}
+            except UserElementNotFound:
+                pass
+            found = {} # uid: (element, error)
+            for uid in uids:
+                try:
+                    result = getattr(ldap, func)([uid])
+                    found[uid] = (result[0], None) if result else (None, uid)
+                except UserElementNotFound as e:
+                    found[uid] = (None, str(e))
+            return entry_point, ldap, found
+        
+        domains = list(domain_dict)
+        for domain, (entry_point, ldap, found) in zip(
+            domains, run_concurrent(find_users, domains, self.workers)):
             if not ldap:
                 self.missing.append(
                     dict(msg='Cannot find specified element',
                          name=domain,
                          type=entry_point))
                 continue
-            for uid in uids:
-                try:
-                    result = getattr(ldap, func)([uid])
-                    self.cache.setdefault('user_element', []).extend(
-                        result)
-                except UserElementNotFound as e:
+            for uid in domain_dict[domain]:
+                element, error = found[uid]
+                if element is None:
                     self.missing.append(
-                        dict(msg='Cannot find specified element: %s' % str(e),
+                        dict(msg='Cannot find specified element: %s' % error,
                              name=uid,
                              type=typeof))
+                else:
+                    self._store('user_element', element)
+    
+    def _store(self, typeof, element, persist=True):
+        # Index the element by typeof/name and by href. User elements are
+        # keyed by href as users and groups of different domains can share
+        # the same name
+        key = element.href if typeof == 'user_element' else element.name
+        self.cache.setdefault(typeof, {})[key] = element
+        self.href_index[element.href] = element
+        if persist and self.store is not None and typeof != 'user_element':
+            self.store.set(typeof, element)
+    
+    def _cached(self, typeof, name):
+        # Element from memory, falling back to the persistent store
+        element = self.get(typeof, name)
+        if element is None and self.store is not None:
+            element = self.store.get(typeof, name)
+            if element is not None:
+                self._store(typeof, element, persist=False)
+        return element
+            
+    def _search(self, typeof):
+        # Collection used to resolve elements of the given typeof
+        from smc.base.collection import Search
+        if typeof == 'engine':
+            return Search.objects.context_filter('engine_clusters')
+        return Search.objects.entry_point(typeof)
+    
+    def _resolve(self, typeof, names):
+        # Find elements by name without changing the cache so it can run
+        # in a worker thread. A single name is filtered by the SMC, many
+        # names of the same typeof are matched in a single listing
+        if len(names) == 1:
+            result = self._search(typeof).filter(names[0], exact_match=True).first()
+            return {names[0]: result} if result else {}
+        wanted = set(names)
+        found = {}
+        for element in self._search(typeof):
+            if element.name in wanted and element.name not in found:
+                found[element.name] = element
+                if len(found) == len(wanted):
+                    break
+        return found
+    
+    def _merge(self, typeof, names, found):
+        # Store resolved elements, names not found are missing
+        for name in names:
+            if name in found:
+                self._store(typeof, found[name])
+            else:
+                self.missing.append(
+                    dict(msg='Cannot find specified element',
+                         name=name,type=typeof))
+    
+    def _add_entries(self, typeof, names):
+        # Resolve many names of the same typeof with a single listing
+        self._merge(typeof, names, self._resolve(typeof, names))
             
     def _add_entry(self, typeof, name):
         # Add entry if it doesn't already exist
-        if self.get(typeof, name):
+        if self._cached(typeof, name):
             return
-        if typeof == 'engine':
-            result = Search.objects.context_filter('engine_clusters')\
-                .filter(name, exact_match=True).first()
-        else:
-            result = Search.objects.entry_point(typeof)\
-                .filter(name, exact_match=True).first()
-        if result:
-            self.cache.setdefault(typeof, []).append(
-                result)
-        else:
-            self.missing.append(
-                dict(msg='Cannot find specified element',
-                     name=name,type=typeof))
+        self._merge(typeof, [name], self._resolve(typeof, [name]))
     
     def get(self, typeof, name):
         """
@@ -122,9 +555,16 @@ class Cache(object):
         :param str name: name of element
         :rtype: element or None
         """
-        for value in self.cache.get(typeof, []):
-            if value.name == name:
-                return value
+        return self.cache.get(typeof, {}).get(name)
+    
+    def get_href(self, href):
+        """
+        Get element by href
+        
+        :param str href: href of element
+        :rtype: element or None
+        """
+        return self.href_index.get(href)
     
     def get_type(self, typeof):
         """
@@ -134,7 +574,7 @@ class Cache(object):
         :rtype: list
         """
         if typeof in self.cache:
-            return self.cache[typeof]
+            return list(self.cache[typeof].values())
         return []
 
     @property
@@ -142,16 +582,98 @@ class Cache(object):
         out = {}
         for typeof, values in self.cache.items():
             out.setdefault(typeof, []).extend(
-                [(value.name, value.href) for value in values])
+                [(value.name, value.href) for value in values.values()])
         return out
 
 
+# Supported element types by typeof, mapped to the smc-python module and
+# class name. Classes are only imported when a type dict is requested so
+# the type names can be used without importing smc-python.
+element_types = dict(
+    host=('smc.elements.network', 'Host'),
+    network=('smc.elements.network', 'Network'),
+    address_range=('smc.elements.network', 'AddressRange'),
+    router=('smc.elements.network', 'Router'),
+    ip_list=('smc.elements.network', 'IPList'),
+    group=('smc.elements.group', 'Group'),
+    netlink=('smc.elements.netlink', 'StaticNetlink'),
+    interface_zone=('smc.elements.network', 'Zone'),
+    domain_name=('smc.elements.network', 'DomainName'))
+
+ro_element_types = dict(
+    alias=('smc.elements.network', 'Alias'),
+    country=('smc.elements.network', 'Country'),
+    expression=('smc.elements.network', 'Expression'),
+    engine=('smc.core.engine', 'Engine'))
+
+service_types = dict(
+    tcp_service=('smc.elements.service', 'TCPService'),
+    udp_service=('smc.elements.service', 'UDPService'),
+    ip_service=('smc.elements.service', 'IPService'),
+    ethernet_service=('smc.elements.service', 'EthernetService'),
+    icmp_service=('smc.elements.service', 'ICMPService'),
+    icmp_ipv6_service=('smc.elements.service', 'ICMPIPv6Service'),
+    service_group=('smc.elements.group', 'ServiceGroup'),
+    tcp_service_group=('smc.elements.group', 'TCPServiceGroup'),
+    udp_service_group=('smc.elements.group', 'UDPServiceGroup'),
+    ip_service_group=('smc.elements.group', 'IPServiceGroup'),
+    icmp_service_group=('smc.elements.group', 'ICMPServiceGroup'))
+
+ro_service_types = dict(
+    url_category=('smc.elements.service', 'URLCategory'),
+    application_situation=('smc.elements.service', 'ApplicationSituation'),
+    protocol=('smc.elements.service', 'Protocol'),
+    rpc_service=('smc.elements.service', 'RPCService'))
+
+
+_argspec_cache = {} # (class, method): (args, defaults)
+
+
+def _argspec(clazz, method):
+    # Memoized argument names and defaults of a class method
+    key = (clazz, method)
+    if key not in _argspec_cache:
+        func = getattr(clazz, method)
+        try:
+            argspec = inspect.getfullargspec(func)
+        except AttributeError: # Python 2
+            argspec = inspect.getargspec(func)
+        _argspec_cache[key] = (argspec.args, argspec.defaults)
+    return _argspec_cache[key]
+
+
+def method_args(clazz, method):
+    """
+    Argument names of a class method, excluding the first (self or cls)
+    argument. Results are memoized per process.
+    
+    :param clazz: class to inspect
+    :param str method: name of the method, i.e. create or __init__
+    :rtype: list
+    """
+    args, _ = _argspec(clazz, method)
+    return args[1:]
+
+
 def required_args(clazz):
-    argspec = inspect.getargspec(clazz.create)
-    if argspec.defaults:
-        args = argspec.args[:-len(argspec.defaults)]
-        return args[1:]
-    return argspec.args[1:]
+    args, defaults = _argspec(clazz, 'create')
+    if defaults:
+        args = args[:-len(defaults)]
+    return args[1:]
+
+
+def _type_dict(types, method, map_only):
+    """
+    Build a type dict from a type table. The `attr` key holds the
+    arguments of the given constructor method.
+    """
+    result = {}
+    for typeof, (module, name) in types.items():
+        clazz = getattr(importlib.import_module(module), name)
+        result[typeof] = dict(type=clazz)
+        if not map_only:
+            result[typeof]['attr'] = method_args(clazz, method)
+    return result
 
     
 def element_type_dict(map_only=False):
@@ -159,26 +681,7 @@ def element_type_dict(map_only=False):
     Type dict constructed with valid `create` constructor arguments.
     This is used in modules that support update_or_create operations
     """
-    types = dict(
-        host=dict(type=network.Host),
-        network=dict(type=network.Network),
-        address_range=dict(type=network.AddressRange),
-        router=dict(type=network.Router),
-        ip_list=dict(type=network.IPList),
-        group=dict(type=group.Group),
-        netlink=dict(type=netlink.StaticNetlink),
-        interface_zone=dict(type=network.Zone),
-        domain_name=dict(type=network.DomainName))
-    
-    if map_only:
-        return types
-    
-    for t in types.keys():
-        clazz = types.get(t)['type']
-        types[t]['attr'] = inspect.getargspec(clazz.create).args[1:]
-        #types[t]['attr'] = required_args(clazz)
-    
-    return types
+    return _type_dict(element_types, 'create', map_only)
 
 
 def ro_element_type_dict(map_only=False):
@@ -186,65 +689,22 @@ def ro_element_type_dict(map_only=False):
     Type dict of read-only network elements. These elements can be
     fetched but not created
     """
-    types = dict(
-        alias=dict(type=network.Alias),
-        country=dict(type=network.Country),
-        expression=dict(type=network.Expression),
-        engine=dict(type=Engine))
-
-    if map_only:
-        return types
-    
-    for t in types.keys():
-        clazz = types.get(t)['type']
-        types[t]['attr'] = inspect.getargspec(clazz.__init__).args[1:]
-    
-    return types
+    return _type_dict(ro_element_types, '__init__', map_only)
 
 
 def service_type_dict(map_only=False):
     """
     Type dict for serviec elements and groups.
     """
-    types = dict(
-        tcp_service=dict(type=service.TCPService),
-        udp_service=dict(type=service.UDPService),
-        ip_service=dict(type=service.IPService),
-        ethernet_service=dict(type=service.EthernetService),
-        icmp_service=dict(type=service.ICMPService),
-        icmp_ipv6_service=dict(type=service.ICMPIPv6Service),
-        service_group=dict(type=group.ServiceGroup),
-        tcp_service_group=dict(type=group.TCPServiceGroup),
-        udp_service_group=dict(type=group.UDPServiceGroup),
-        ip_service_group=dict(type=group.IPServiceGroup),
-        icmp_service_group=dict(type=group.ICMPServiceGroup))
-    
-    if map_only:
-        return types
-    
-    for t in types.keys():
-        clazz = types.get(t)['type']
-        types[t]['attr'] = inspect.getargspec(clazz.create).args[1:]
-    
-    return types
+    return _type_dict(service_types, 'create', map_only)
 
 
-def ro_service_type_dict():
+def ro_service_type_dict(map_only=False):
     """
     Type dict of read-only service elements. These elements can be
     fetched but not created
     """
-    types = dict(
-        url_category=dict(type=service.URLCategory),
-        application_situation=dict(type=service.ApplicationSituation),
-        protocol=dict(type=service.Protocol),
-        rpc_service=dict(type=service.RPCService))
-    
-    for t in types.keys():
-        clazz = types.get(t)['type']
-        types[t]['attr'] = inspect.getargspec(clazz.__init__).args[1:]
-    
-    return types
+    return _type_dict(ro_service_types, '__init__', map_only)
 
                 
 def update_or_create(element, type_dict, check_mode=False):
@@ -290,6 +750,9 @@ def update_or_create(element, type_dict, check_mode=False):
                 
                 if modified or created:
                     result['action'] = 'created' if created else 'updated'
+                
+                if created and Cache.store is not None:
+                    Cache.store.invalidate(element.name, element.typeof)
 
             else:
                 element = _type_dict['type'].get(values.get('name'), raise_exc=False)
@@ -318,10 +781,14 @@ def delete_element(element, ignore_if_not_found=True):
         dependency on this element (i.e. used in policy, etc).
     :return: list or None
     """
+    from smc.api.exceptions import ElementNotFound, DeleteElementFailed
+    
     msg = {}
     try:
         element.delete()
         msg['action'] = 'deleted'
+        if Cache.store is not None:
+            Cache.store.invalidate(element.name, element.typeof)
     except ElementNotFound:
         msg['msg'] = 'Element not found, skipping delete'
     except DeleteElementFailed as e:
@@ -382,7 +849,9 @@ def smc_argument_spec():
         smc_domain=dict(type='str'),
         smc_alt_filepath=dict(type='str'),
         smc_extra_args=dict(type='dict'),
-        smc_logging=dict(type='dict')
+        smc_logging=dict(type='dict'),
+        smc_cache=dict(type='dict'),
+        smc_session=dict(type='dict')
     )
 
 
@@ -397,12 +866,19 @@ def fact_argument_spec():
 
 
 class StonesoftModuleBase(object):
+    # Set by the smc_client connection plugin when modules are run within
+    # the persistent connection process that owns the SMC session
+    persistent = False
+    
     def __init__(self, module_args, required_if=None, bypass_checks=False,
                  no_log=False, check_invalid_arguments=True,
                  mutually_exclusive=None, required_together=None,
                  required_one_of=None, add_file_common_args=False,
                  supports_check_mode=False, is_fact=False):
         
+        self.session_store = None
+        self.connection_domain = None
+        
         argument_spec = smc_argument_spec()
         if is_fact:
             argument_spec.update(fact_argument_spec())
@@ -420,10 +896,11 @@ class StonesoftModuleBase(object):
             add_file_common_args=add_file_common_args,
             supports_check_mode=supports_check_mode)
         
-        if not HAS_LIB:
-            self.module.fail_json(msg='Could not import smc-python required by this module')
-        
         self.check_mode = self.module.check_mode
+        
+        if self.module._socket_path and not self.persistent:
+            self.run_on_connection()
+        
         self.connect(self.module.params)
             
         result = self.exec_module(**self.module.params)
@@ -437,6 +914,11 @@ class StonesoftModuleBase(object):
         
         :param dict params: dict of the SMC credential information
         """
+        if not import_smc():
+            self.module.fail_json(msg='Could not import smc-python required by this module')
+        
+        from smc import session
+        from smc.api.exceptions import ConfigLoadError, SMCException
         try:
             if params.get('smc_logging') is not None:
                 if 'path' not in params['smc_logging']:
@@ -446,7 +928,21 @@ class StonesoftModuleBase(object):
                     log_level=params['smc_logging'].get('level', 10),
                     path=params['smc_logging']['path'])
             
-            if 'smc_address' and 'smc_api_key' in params:    
+            if params.get('smc_session') is not None:
+                if 'path' not in params['smc_session']:
+                    self.fail(msg='You must specify a path for the SMC session.')
+                
+                self.session_store = SessionStore(
+                    path=params['smc_session']['path'],
+                    login_params=login_params(params))
+            
+            if self.persistent and session.is_active:
+                # Session is owned by the smc_client connection process
+                self.use_connection_session(session, params)
+            elif self.session_store is not None and self.session_store.restore(session):
+                # Persisted session is still valid, login is not required
+                pass
+            elif 'smc_address' and 'smc_api_key' in params:    
                 extra_args = params.get('smc_extra_args')
                 # When connection parameters are defined, alt_filepath is ignored.
                 session.login(
@@ -462,19 +958,97 @@ class StonesoftModuleBase(object):
             else:
                 # From user ~.smcrc or environment
                 session.login()
+            
+            if params.get('smc_cache') is not None:
+                if 'path' not in params['smc_cache']:
+                    self.fail(msg='You must specify a path for the SMC cache.')
+                
+                Cache.store = PersistentCache(
+                    path=params['smc_cache']['path'],
+                    ttl=params['smc_cache'].get('ttl', 600),
+                    url=session.url,
+                    domain=session.domain)
         
         except (ConfigLoadError, SMCException) as err:
             self.fail(msg=str(err), exception=traceback.format_exc())
 
+    def use_connection_session(self, session, params):
+        """
+        Check the SMC parameters of the module against the session of the
+        smc_client connection. The module fails if it specifies another SMC,
+        API key or API version. If only the domain differs, the session is
+        switched to that domain for this module and back in disconnect.
+        Resolved elements are not shared with other tasks in that case.
+        
+        :param Session session: active session of the connection
+        :param dict params: dict of the SMC credential information
+        """
+        differ = [name for name, value in (
+                ('smc_address', session.url),
+                ('smc_api_key', session._params.get('api_key')),
+                ('smc_api_version', session.api_version))
+            if params.get(name) and
+                str(params[name]).rstrip('/') != str(value).rstrip('/')]
+        if differ:
+            self.fail(msg='Module parameters %s do not match the SMC session of the '
+                'smc_client connection. Use a separate connection for a different SMC '
+                'or credentials.' % ', '.join(differ))
+        
+        domain = params.get('smc_domain')
+        if domain and domain != session.domain:
+            self.connection_domain = session.domain
+            Cache.store = None
+            session.switch_domain(domain)
+    
     def disconnect(self):
         """
-        Disconnect session from SMC after ansible run
+        Disconnect session from SMC after ansible run. If the session
+        is persisted with `smc_session`, it is saved instead of logged out.
         """
+        if not HAS_LIB:
+            return
+        from smc import session
+        from smc.api.exceptions import SMCException
+        
+        if Cache.store is not None:
+            Cache.store.save()
+        if self.persistent:
+            if self.connection_domain is not None:
+                domain, self.connection_domain = self.connection_domain, None
+                try:
+                    session.switch_domain(domain)
+                except SMCException:
+                    pass
+            return
+        if self.session_store is not None and session.is_active:
+            # Keep the session open on the SMC for the next task. Removing it
+            # from the session manager prevents logout when the interpreter exits
+            self.session_store.save(session)
+            session.manager._deregister(session)
+            return
         try:
             session.logout()
         except SMCException:
             pass
     
+    def run_on_connection(self):
+        """
+        Run this module within the smc_client persistent connection process.
+        The process keeps an authenticated session and resolved elements
+        between tasks, so the module parameters are sent over the connection
+        socket and the result is returned as the result of this module.
+        """
+        from ansible.module_utils.connection import Connection, ConnectionError
+        try:
+            result = Connection(self.module._socket_path).run_module(
+                self.module._name, self.module.params, self.check_mode)
+        except ConnectionError as err:
+            self.module.fail_json(msg=str(err))
+        
+        if result.pop('failed', False):
+            self.module.fail_json(**result)
+        self.module.exit_json(**result)
+    
     def exec_module(self):
         self.fail(msg='Override in sub-module. Called from: {}'.format(self.__class__.__name__))
     
@@ -488,6 +1062,7 @@ class StonesoftModuleBase(object):
         :return: list of metadata results
         :rtype: list
         """
+        from smc.base.collection import Search
         if self.filter:
             # Find specific
             iterator = Search.objects\
@@ -562,6 +1137,7 @@ class StonesoftModuleBase(object):
         :param list tags: list of tags by name
         :return: boolean success or fail
         """
+        from smc.elements.other import Category
         changed = False
         current_tags = [tag.name for tag in element.categories]
         for tag in tags: